@@ -83,13 +83,13 @@ class BlogCollection: RouteCollection {
         return result
     }
 
-    func readAll(_ req: Request) async throws -> [Blog.DTO] {
+    func readAll(_ req: Request) async throws -> [Blog.ListDTO] {
         let queries = try req.query.decode(Blog.Queries.self)
 
         return try await req.blog.readAll(queries: queries).map {
             var models = try $0.bridged()
             try models.beforeEncode()
-            return models
+            return Blog.ListDTO(models)
         }
     }
 
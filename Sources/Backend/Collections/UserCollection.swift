@@ -149,7 +149,7 @@ class UserCollection: RouteCollection {
 }
 
 extension UserCollection {
-    func readAllBlog(_ req: Request) async throws -> [Blog.DTO] {
+    func readAllBlog(_ req: Request) async throws -> [Blog.ListDTO] {
         let user = try await identified(on: req, queries: nil)
 
         return try await req.blog.queryAll()
@@ -158,7 +158,7 @@ extension UserCollection {
             .map {
                 var models = try $0.bridged()
                 try models.beforeEncode()
-                return models
+                return Blog.ListDTO(models)
             }
     }
 }
@@ -12,7 +12,7 @@ struct BlogRepository: Repository {
     }
 
     func query(owned: Bool = false) throws -> QueryBuilder<Model> {
-        let query = Blog.query(on: request.db).with(\.$categories)
+        let query = Blog.query(on: request.db).with(.categories)
 
         if owned {
             try query.filter(\.$user.$id == request.owner.__id)
@@ -22,23 +22,13 @@ struct BlogRepository: Repository {
     }
 
     func queryAll(owned: Bool = false) throws -> QueryBuilder<Model> {
-        try query(owned: owned)
-            .field(\.$id)
-            .field(\.$alias)
-            .field(\.$title)
-            .field(\.$artworkUrl)
-            .field(\.$excerpt)
-            .field(\.$tags)
-            .field(\.$createdAt)
-            .field(\.$updatedAt)
-            .field(\.$user.$id)
+        try query(owned: owned).listProjection()
     }
 
     func create(_ model: Model, categories: [BlogCategory]) async throws {
         try await request.owner.$blog.create(model, on: request.db)
 
-        try await model.$categories.attach(categories, on: request.db)
-        try await model.$categories.load(on: request.db)
+        try await model.attachCategories(categories, on: request.db)
     }
 
     func identified(by alias: String) async throws -> Model {
@@ -59,9 +49,7 @@ struct BlogRepository: Repository {
     func update(_ model: Model, categories: [BlogCategory]) async throws {
         try await model.save(on: request.db)
 
-        try await model.$categories.detachAll(on: request.db)
-        try await model.$categories.attach(categories, on: request.db)
-        try await model.$categories.load(on: request.db)
+        try await model.replaceCategories(with: categories, on: request.db)
     }
 
     func delete(_ id: Model.IDValue) async throws {
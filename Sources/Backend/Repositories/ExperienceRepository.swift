@@ -12,7 +12,7 @@ struct ExperienceRepository: Repository {
     }
 
     func query(owned: Bool = false) throws -> QueryBuilder<Model> {
-        let query = Model.query(on: request.db).with(\.$industries)
+        let query = Model.query(on: request.db).with(.industries)
 
         if owned {
             try query.filter(\.$user.$id == request.owner.__id)
@@ -24,16 +24,13 @@ struct ExperienceRepository: Repository {
     func create(_ model: Model, industries: [Industry]) async throws {
         try await request.owner.$experiences.create(model, on: request.db)
 
-        try await model.$industries.attach(industries, on: request.db)
-        try await model.$industries.load(on: request.db)
+        try await model.attachIndustries(industries, on: request.db)
     }
 
     func update(_ model: Model, industries: [Industry]) async throws {
         try await model.save(on: request.db)
 
-        try await model.$industries.detachAll(on: request.db)
-        try await model.$industries.attach(industries, on: request.db)
-        try await model.$industries.load(on: request.db)
+        try await model.replaceIndustries(with: industries, on: request.db)
     }
 
     func delete(_ id: Model.IDValue) async throws {
@@ -94,6 +94,39 @@ class BlogCollectionTests: XCTestCase {
         )
     }
 
+    func testCreateBlogReturnsStoredCategories() throws {
+        var category = BlogCategory.DTO.generate()
+        var expected = Model.generate()
+
+        try app.test(
+            .POST,
+            BlogCategory.schema,
+            beforeRequest: {
+                try $0.content.encode(category)
+            },
+            afterResponse: {
+                XCTAssertEqual($0.status, .ok)
+                category = try $0.content.decode(BlogCategory.DTO.self)
+                var renamed = category
+                renamed.name = .random(length: 7)
+                expected.categories = [renamed]
+            }
+        )
+        .test(
+            .POST,
+            uri,
+            headers: app.login().headers,
+            beforeRequest: {
+                try $0.content.encode(expected)
+            },
+            afterResponse: {
+                XCTAssertEqual($0.status, .ok)
+                let model = try $0.content.decode(Model.self)
+                XCTAssertEqual(model.categories, [category])
+            }
+        )
+    }
+
     func testQueryBlogWithIDThatDoesNotExsit() throws {
         XCTAssertNoThrow(
             try app.test(.GET, uri + "/0", afterResponse: assertHTTPStatusEqualToNotFound)
@@ -139,6 +172,46 @@ class BlogCollectionTests: XCTestCase {
         )
     }
 
+    func testQueryAllBlog() throws {
+        var category = BlogCategory.DTO.generate()
+        var expected = Model.generate()
+
+        try app.test(
+            .POST,
+            BlogCategory.schema,
+            beforeRequest: {
+                try $0.content.encode(category)
+            },
+            afterResponse: {
+                XCTAssertEqual($0.status, .ok)
+                category = try $0.content.decode(BlogCategory.DTO.self)
+                expected.categories = [category]
+            }
+        )
+        .test(
+            .POST,
+            uri,
+            headers: app.login().headers,
+            beforeRequest: {
+                try $0.content.encode(expected)
+            },
+            afterResponse: {
+                XCTAssertEqual($0.status, .ok)
+                expected = try $0.content.decode(Model.self)
+            }
+        )
+        .test(
+            .GET,
+            uri,
+            afterResponse: {
+                XCTAssertEqual($0.status, .ok)
+                XCTAssertFalse($0.body.string.contains("\"content\""))
+                let models = try $0.content.decode([Blog.ListDTO].self)
+                XCTAssertEqual(models, [Blog.ListDTO(expected)])
+            }
+        )
+    }
+
     func testUpdateBlog() throws {
        var category = BlogCategory.DTO.generate()
         var original = Model.generate()
@@ -0,0 +1,71 @@
+import XCTVapor
+
+@testable import Backend
+
+class CompactCodingTests: XCTestCase {
+
+    private func encodedKeys<T: Encodable>(_ value: T) throws -> Set<String> {
+        let data = try JSONEncoder().encode(value)
+        let object = try XCTUnwrap(JSONSerialization.jsonObject(with: data) as? [String: Any])
+        return Set(object.keys)
+    }
+
+    func testEncodeBlogWithoutNilAndEmptyFields() throws {
+        var blog = Blog.DTO.generate()
+        blog.content = nil
+        blog.tags = nil
+        blog.categories = []
+
+        let keys = try encodedKeys(blog)
+        XCTAssertEqual(keys, ["id", "alias", "title", "excerpt"])
+        XCTAssertEqual(try JSONDecoder().decode(Blog.DTO.self, from: JSONEncoder().encode(blog)), blog)
+    }
+
+    func testEncodeBlogWithNonEmptyFields() throws {
+        var blog = Blog.DTO.generate()
+        blog.tags = [.random(length: 5)]
+        blog.categories = [.generate()]
+
+        let keys = try encodedKeys(blog)
+        XCTAssertTrue(keys.isSuperset(of: ["content", "tags", "categories"]))
+        XCTAssertEqual(try JSONDecoder().decode(Blog.DTO.self, from: JSONEncoder().encode(blog)), blog)
+    }
+
+    func testDecodeBlogWithMissingFields() throws {
+        let json = #"{"id": 1, "alias": "alias", "title": "title", "excerpt": "excerpt"}"#
+
+        let blog = try JSONDecoder().decode(Blog.DTO.self, from: Data(json.utf8))
+        XCTAssertNil(blog.content)
+        XCTAssertNil(blog.tags)
+        XCTAssertEqual(blog.categories, [])
+
+        let list = try JSONDecoder().decode(Blog.ListDTO.self, from: Data(json.utf8))
+        XCTAssertEqual(list.categories, [])
+    }
+
+    func testDecodeBlogWithMissingRequiredField() throws {
+        let json = #"{"id": 1, "alias": "alias", "title": "title"}"#
+
+        XCTAssertThrowsError(try JSONDecoder().decode(Blog.DTO.self, from: Data(json.utf8)))
+    }
+
+    func testEncodeUserWithoutNilFields() throws {
+        var user = User.DTO.init()
+        user.username = .random(length: 8)
+        user.firstName = .random(length: 6)
+        user.lastName = .random(length: 7)
+
+        let keys = try encodedKeys(user)
+        XCTAssertEqual(keys, ["id", "username", "firstName", "lastName"])
+        XCTAssertEqual(try JSONDecoder().decode(User.DTO.self, from: JSONEncoder().encode(user)), user)
+    }
+
+    func testEncodeUserWithEmptyCollections() throws {
+        var user = User.DTO.init()
+        user.blog = []
+        user.projects = []
+
+        let keys = try encodedKeys(user)
+        XCTAssertTrue(keys.isSuperset(of: ["blog", "projects"]))
+    }
+}
@@ -5,20 +5,46 @@ The ultimate tool for building books.
 """
 
 import argparse
+import hashlib
+import json
 import os
 from pathlib import Path
+import re
 import subprocess
 import sys
-import tempfile
-from typing import List, Literal, Optional, Union
+import time
+from typing import Callable, Dict, List, Literal, Optional, Tuple, Union
 
 
 PACKAGE_DIR = Path(".")
 LIBRARY_DIR = PACKAGE_DIR.joinpath("Sources", "Backend")
+TESTS_DIR = PACKAGE_DIR.joinpath("Tests")
+UTILS_DIR = PACKAGE_DIR.joinpath("utils")
 PACKAGE_NAME = "swift-blog"
 PRODUCT_NAME = "swift-blog"
 
 GYB_EXEC = PACKAGE_DIR.joinpath("utils", "gyb").as_posix()
+GYB_CACHE_DIR = PACKAGE_DIR.joinpath(".build", "gyb-cache").as_posix()
+# Templates are expanded by `gyb --serve --socket .build/gyb.sock` when it is
+# running.
+GYB_SOCKET = PACKAGE_DIR.joinpath(".build", "gyb.sock").as_posix()
+
+# Records the inputs every autogenerated file was generated from, it is stored
+# next to the `autogenerated` directory.
+GYB_MANIFEST_FILE_NAME = ".autogenerated.json"
+
+# The recorded durations in seconds of every test, by `Module.Class/test`,
+# used to balance test shards and to find slow tests.
+TEST_DURATIONS_FILE = PACKAGE_DIR.joinpath(".build", "test-durations.json").as_posix()
+# The number of runs kept for every test in TEST_DURATIONS_FILE.
+TEST_DURATIONS_HISTORY = 10
+
+# A finished test in XCTest output, as printed on Linux and on macOS.
+XCTEST_CASE_RE = re.compile(
+    r"Test Case '(?:-\[(?:(?P<module>\w+)\.)?(?P<class>\w+) (?P<test>\w+)\]"
+    r"|(?:(?P<linux_module>\w+)\.)?(?P<linux_class>\w+)\.(?P<linux_test>\w+))' "
+    r"(?P<result>passed|failed|skipped) \((?P<duration>\d+(?:\.\d+)?) seconds\)"
+)
 
 BASE_KIND_FILES = [
     "Blog",
@@ -70,6 +96,25 @@ def check_call(cmd: _CMD, verbose: Optional[bool], cwd: Path = None, env=os.envi
     return subprocess.check_call(cmd, cwd=cwd, env=env, stderr=subprocess.STDOUT)
 
 
+def check_call_streaming(
+    cmd: List[str], verbose: Optional[bool], on_line: Callable[[str], None]
+):
+    """Run cmd like check_call, passing every line it outputs through to
+    stdout and to on_line as soon as it is printed."""
+    if verbose:
+        print(" ".join([escape_cmd_arg(arg) for arg in cmd]))
+    with subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1
+    ) as process:
+        for line in process.stdout:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+            on_line(line)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    return 0
+
+
 def check_gyb_exec(exec: Optional[str]):
     if not (exec and Path(exec).exists()):
         fatal_error(
@@ -81,12 +126,6 @@ Looking at '%s'.
         )
 
 
-def check_rsync():
-    with open(os.devnull, "w") as DEVNULL:
-        if call(["rsync", "--version"], verbose=False, stdout=DEVNULL) != 0:
-            fatal_error("Error: Could not find rsync.")
-
-
 def generate_xcodeproj():
     print("Generate {} as an Xcode project".format(PRODUCT_NAME))
     os.chdir(PACKAGE_DIR)
@@ -96,74 +135,213 @@ def generate_xcodeproj():
     return check_call(popenargs)
 
 
-def _generate_file_from_gyb_file(
-    exec: Union[Path, str],
-    input_file: Path,
-    output_file_name: str,
-    destination: Path,
-    temp_files_dir: Path,
-    verbose: Optional[bool],
-    other_flags: List[str] = [],
-):
-    if isinstance(exec, Path):
-        exec = exec.as_posix()
-
-    popenargs = [
-        sys.executable,
-        exec,
-        input_file.as_posix(),
-        "--line-directive=",
-        "-o",
-        temp_files_dir.joinpath(output_file_name).as_posix(),
-    ]
+def _load_gyb(exec: Union[Path, str]):
+    """Import the gyb module that lives next to the gyb executable."""
+    gyb_dir = Path(exec).resolve().parent.as_posix()
+    if gyb_dir not in sys.path:
+        sys.path.insert(0, gyb_dir)
+
+    import gyb
+
+    return gyb
+
+
+def _validate_schemas(exec: Union[Path, str], templates: List[Path]):
+    """Load the Fluent.json next to every template, which raises a
+    SchemaError listing every problem in it before anything is generated."""
+    _load_gyb(exec)
+    import fluent_schema
 
-    popenargs += other_flags
+    for path in templates:
+        schema = path.parent.joinpath("Fluent.json")
+        if schema.exists():
+            fluent_schema.load(schema)
 
-    check_call(popenargs, verbose=verbose)
 
-    # Copy the file if different from the file already present in
-    # gyb
-    popenargs = [
-        "rsync",
-        "--checksum",
-        temp_files_dir.joinpath(output_file_name).as_posix(),
-        destination.joinpath(output_file_name).as_posix(),
+def _load_generate_linux_tests():
+    """Import generate_linux_tests from the utils directory."""
+    utils_dir = UTILS_DIR.resolve().as_posix()
+    if utils_dir not in sys.path:
+        sys.path.insert(0, utils_dir)
+
+    import generate_linux_tests
+
+    return generate_linux_tests
+
+
+def write_if_changed(path: Path, text: str, verbose: Optional[bool] = False):
+    """Atomically replace the file at path with text, unless it already has
+    exactly that content, see generate_linux_tests.write_if_changed."""
+    return _load_generate_linux_tests().write_if_changed(path, text, verbose)
+
+
+def _gyb_jobs_for_template(src: Path, dst: Path, tags: List[str]):
+    return [
+        (src, tag + ".swift", dst, {"EMIT_KIND": tag}) for tag in tags
     ]
 
-    check_call(popenargs, verbose=verbose)
+
+_GYB_JOB = Tuple[Path, str, Path, Dict[str, str]]
 
 
-def _generate_files_from_gyb_template(
+def _run_gyb_jobs(
     exec: Union[Path, str],
-    src: Path,
-    dst: Path,
-    tags: List[str],
-    temp_files_dir: Path,
+    gyb_jobs: List[_GYB_JOB],
+    cache_dir: Optional[str],
+    jobs: int,
     verbose: Optional[bool],
+    socket: Optional[str] = None,
 ):
-    for tag in tags:
-        _generate_file_from_gyb_file(
-            exec=exec,
-            input_file=src,
-            output_file_name=tag + ".swift",
-            destination=dst,
-            temp_files_dir=temp_files_dir,
-            other_flags=["-DEMIT_KIND=%s" % tag],
-            verbose=verbose,
+    """Expand all jobs and return the dependencies of every generated file.
+
+    The gyb server listening on `socket` expands the templates if there is
+    one, otherwise they are expanded in this process.
+    """
+    gyb = _load_gyb(exec)
+    cache = gyb.TemplateCache(cache_dir) if cache_dir else None
+
+    # Group jobs by template, so that each template is parsed only once.
+    templates = {}
+    for job in gyb_jobs:
+        templates.setdefault(job[0], []).append(job)
+
+    dependencies = {}
+    for input_file, template_jobs in templates.items():
+        if verbose:
+            for _, output_file_name, _, bindings in template_jobs:
+                print(
+                    "gyb {} -o {} {}".format(
+                        input_file.as_posix(),
+                        output_file_name,
+                        " ".join("-D%s=%s" % item for item in bindings.items()),
+                    )
+                )
+
+        binding_sets = [bindings for _, _, _, bindings in template_jobs]
+        results = None
+        if socket:
+            try:
+                results = gyb.expand_remote(
+                    socket,
+                    input_file.as_posix(),
+                    binding_sets,
+                    line_directive="",
+                    jobs=jobs,
+                    compiled=True,
+                )
+            except (OSError, gyb.ServerError) as e:
+                if verbose:
+                    reason = str(e).strip().splitlines() or [type(e).__name__]
+                    print(
+                        "gyb server unavailable, expanding in-process: "
+                        + reason[-1]
+                    )
+            else:
+                if verbose:
+                    print("Expanded by the gyb server at " + socket)
+
+        if results is None:
+            results = gyb.expand_all(
+                input_file.as_posix(),
+                binding_sets,
+                line_directive="",
+                jobs=jobs,
+                cache=cache,
+                compiled=True,
+            )
+
+        for (_, output_file_name, destination, _), (text, paths) in zip(
+            template_jobs, results
+        ):
+            write_if_changed(destination.joinpath(output_file_name), text, verbose)
+            dependencies[destination, output_file_name] = [
+                os.path.relpath(path) for path in paths
+            ]
+
+    if verbose and cache is not None:
+        print(
+            "gyb template cache: {} hits, {} misses, {} evictions".format(
+                cache.hits, cache.misses, cache.evictions
+            )
         )
 
+    return dependencies
 
-def generate_files(exec: Union[Path, str], verbose: Optional[bool]):
+
+def _file_digest(path: Path, digests: Dict[Path, Optional[str]]):
+    if path not in digests:
+        try:
+            with open(path, "rb") as f:
+                digests[path] = hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            digests[path] = None
+    return digests[path]
+
+
+def _gyb_job_signature(
+    job: _GYB_JOB,
+    inputs: List[str],
+    gyb_version: str,
+    digests: Dict[Path, Optional[str]],
+):
+    input_file, output_file_name, destination, bindings = job
+    inputs = set(inputs)
+    inputs.add(input_file.as_posix())
+    return {
+        "inputs": {path: _file_digest(Path(path), digests) for path in sorted(inputs)},
+        "defines": bindings,
+        "gyb": gyb_version,
+        "output": _file_digest(destination.joinpath(output_file_name), digests),
+    }
+
+
+def _load_gyb_manifest(destination: Path):
+    try:
+        with open(destination.parent.joinpath(GYB_MANIFEST_FILE_NAME)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+
+def _save_gyb_manifest(destination: Path, manifest: Dict[str, dict]):
+    path = destination.parent.joinpath(GYB_MANIFEST_FILE_NAME)
+    write_if_changed(path, json.dumps(manifest, indent=2, sort_keys=True) + "\n")
+
+
+def _forget_changed_modules(
+    manifests: Dict[Path, Dict[str, dict]], digests: Dict[Path, Optional[str]]
+):
+    """Remove the modules imported from an input of the manifests that changed
+    since they were saved from sys.modules, so they are imported again."""
+    changed = set()
+    for manifest in manifests.values():
+        for entry in manifest.values():
+            for path, digest in entry.get("inputs", {}).items():
+                if _file_digest(Path(path), digests) != digest:
+                    changed.add(os.path.abspath(path))
+
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, "__file__", None)
+        if isinstance(path, str) and os.path.abspath(path) in changed:
+            del sys.modules[name]
+
+
+def generate_files(
+    exec: Union[Path, str],
+    verbose: Optional[bool],
+    jobs: int = 1,
+    cache_dir: Optional[str] = None,
+    socket: Optional[str] = None,
+):
     if verbose:
         print("Planning generate files")
     print("Generating files...")
 
     check_gyb_exec(exec)
-    check_rsync()
-
-    temp_files_dir = Path(tempfile.gettempdir())
-    temp_files_dir.mkdir(parents=True, exist_ok=True)
 
+    gyb_jobs = []
+    templates = []
     parent = None
     # Auto generate files that defined in gyb file.
     for path in LIBRARY_DIR.rglob("*.gyb"):
@@ -175,14 +353,7 @@ def generate_files(exec: Union[Path, str], verbose: Optional[bool]):
             _remove_autogenerated_files(path.parent, destination, verbose)
             parent = path.parent
 
-        _generate_file_from_gyb_file(
-            exec,
-            path,
-            path.name[:-4],
-            destination,
-            temp_files_dir,
-            verbose,
-        )
+        gyb_jobs.append((path, path.name[:-4], destination, {}))
 
     # Auto generate files that defined in gyb template.
     for path in LIBRARY_DIR.rglob("*.gyb.template"):
@@ -194,9 +365,55 @@ def generate_files(exec: Union[Path, str], verbose: Optional[bool]):
             _remove_autogenerated_files(path.parent, destination, verbose)
             parent = path.parent
 
-        _generate_files_from_gyb_template(
-            exec, path, destination, BASE_KIND_FILES, temp_files_dir, verbose
-        )
+        gyb_jobs += _gyb_jobs_for_template(path, destination, BASE_KIND_FILES)
+        templates.append(path)
+
+    digests = {}
+    manifests = {}
+    for _, _, destination, _ in gyb_jobs:
+        if destination not in manifests:
+            manifests[destination] = _load_gyb_manifest(destination)
+
+    # A long-running build script (see --watch) must not validate or expand
+    # with helper modules imported before they changed.
+    _forget_changed_modules(manifests, digests)
+    _validate_schemas(exec, templates)
+
+    # Skip every output whose inputs, defines and gyb version are unchanged
+    # since it was last generated. The inputs are the template and every file
+    # gyb recorded the template reading or importing.
+    gyb_version = _load_gyb(exec).version()
+    stale_jobs = []
+    for job in gyb_jobs:
+        _, output_file_name, destination, _ = job
+        entry = manifests[destination].get(output_file_name)
+        if not entry or entry != _gyb_job_signature(
+            job, entry.get("inputs", []), gyb_version, digests
+        ):
+            stale_jobs.append(job)
+
+    if not stale_jobs:
+        print("Generated files are up to date.")
+        return
+
+    dependencies = _run_gyb_jobs(exec, stale_jobs, cache_dir, jobs, verbose, socket)
+
+    # Files were (re)written, so their digests must be computed again.
+    digests = {}
+    for destination, manifest in manifests.items():
+        updated = {}
+        for job in gyb_jobs:
+            _, output_file_name, job_destination, _ = job
+            if job_destination != destination:
+                continue
+            if (destination, output_file_name) in dependencies:
+                inputs = dependencies[destination, output_file_name]
+                updated[output_file_name] = _gyb_job_signature(
+                    job, inputs, gyb_version, digests
+                )
+            else:
+                updated[output_file_name] = manifest[output_file_name]
+        _save_gyb_manifest(destination, updated)
 
     print("Generate complete!")
 
@@ -211,6 +428,140 @@ def _remove_autogenerated_files(src: Path, dst: Path, verbose: Optional[bool],):
             check_call(["rm", dir], cwd=dst, verbose=verbose)
 
 
+def _load_test_durations(path: str):
+    """Return the mean recorded duration of every test, by specifier."""
+    return _mean_test_durations(_load_test_history(path))
+
+
+def _mean_test_durations(history: dict):
+    history = history.get("tests")
+    if not isinstance(history, dict):
+        return {}
+
+    durations = {}
+    for test, recorded in history.items():
+        if isinstance(recorded, list) and recorded:
+            durations[test] = sum(recorded) / len(recorded)
+    return durations
+
+
+def shard_test_cases(
+    tests: Dict[str, List[Tuple[str, List[str]]]],
+    durations: Dict[str, float],
+    shard_count: int,
+):
+    """Partition the test case classes of every module in tests into
+    shard_count shards of about the same total duration.
+
+    A test case weighs the sum of the recorded durations of its tests, a
+    test without any weighs the mean of the recorded ones, so without any
+    history the shards have about the same number of tests. Classes are
+    assigned heaviest first to the lightest shard, which gives the same
+    shards on every machine.
+    """
+    default = sum(durations.values()) / len(durations) if durations else 1.0
+
+    weights = {}
+    for module, classes in tests.items():
+        for name, methods in classes:
+            case = "{}.{}".format(module, name)
+            weights[case] = weights.get(case, 0.0) + sum(
+                durations.get("{}/{}".format(case, x), default) for x in methods
+            )
+
+    shards = [[] for _ in range(shard_count)]
+    loads = [0.0] * shard_count
+    for case in sorted(weights, key=lambda x: (-weights[x], x)):
+        index = loads.index(min(loads))
+        shards[index].append(case)
+        loads[index] += weights[case]
+    return shards
+
+
+class TestTimings:
+    """Collects the duration of every test from XCTest output, and compares
+    them with the history recorded in TEST_DURATIONS_FILE."""
+
+    def __init__(self, modules: Dict[str, str]):
+        # The module of every test case class, since XCTest on Linux only
+        # prints the class.
+        self.modules = modules
+        self.durations = {}
+
+    def feed(self, line: str):
+        match = XCTEST_CASE_RE.search(line)
+        if not match or match.group("result") == "skipped":
+            return
+        groups = match.groupdict()
+        module = groups["module"] or groups["linux_module"]
+        name = groups["class"] or groups["linux_class"]
+        test = groups["test"] or groups["linux_test"]
+        module = module or self.modules.get(name)
+        case = "{}.{}".format(module, name) if module else name
+        self.durations["{}/{}".format(case, test)] = float(match.group("duration"))
+
+    def save(self, path: str, history: dict):
+        """Append the durations to the history and write it to path."""
+        tests = history.setdefault("tests", {})
+        for test, duration in self.durations.items():
+            recorded = tests.get(test)
+            if not isinstance(recorded, list):
+                recorded = []
+            tests[test] = (recorded + [duration])[-TEST_DURATIONS_HISTORY:]
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        write_if_changed(Path(path), json.dumps(history, indent=2, sort_keys=True) + "\n")
+
+    def report(self, slowest: int, previous: Dict[str, float], tolerance: float):
+        """Print the slowest tests, and the test cases that took more than
+        tolerance longer than the mean of their previous runs."""
+        if not self.durations:
+            return
+
+        ranked = sorted(self.durations.items(), key=lambda x: (-x[1], x[0]))
+        if slowest > 0:
+            print("Slowest {} tests:".format(min(slowest, len(ranked))))
+            for test, duration in ranked[:slowest]:
+                print("{:>10.3f}s  {}".format(duration, test))
+
+        # Only compare the tests of every case that ran before.
+        cases = {}
+        for test, duration in self.durations.items():
+            if test in previous:
+                case = cases.setdefault(test.split("/")[0], [0.0, 0.0])
+                case[0] += duration
+                case[1] += previous[test]
+
+        regressed = [
+            (case, new, old)
+            for case, (new, old) in sorted(cases.items())
+            # Ignore noise in cases that take almost no time.
+            if new - old > 0.05 and new > old * (1 + tolerance)
+        ]
+        if regressed:
+            print("Test cases slower than their previous runs:")
+            for case, new, old in regressed:
+                print(
+                    "{:>10.3f}s  {} (was {:.3f}s, {:+.0%})".format(
+                        new, case, old, new / old - 1 if old else 0
+                    )
+                )
+
+
+def _load_test_history(path: str):
+    try:
+        with open(path) as f:
+            history = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return history if isinstance(history, dict) else {}
+
+
+def _test_filter(test_cases: List[str]):
+    """Return the `swift test --filter` regular expression that matches every
+    test of test_cases."""
+    return "^({})/".format("|".join(re.escape(x) for x in sorted(test_cases)))
+
+
 def swift_execute(
     action: Literal["build", "test"],
     configuration: _CONFIG,
@@ -219,6 +570,8 @@ def swift_execute(
     parallel: bool = False,
     static_stdlib: bool = False,
     verbose: bool = False,
+    filter: Optional[str] = None,
+    on_line: Optional[Callable[[str], None]] = None,
 ):
     popenargs = ["/usr/bin/swift", action]
     
@@ -237,6 +590,9 @@ def swift_execute(
     
     if action == "test" and parallel:
         popenargs.append("--parallel")
+
+    if action == "test" and filter:
+        popenargs.extend(["--filter", filter])
     
     if static_stdlib:
         popenargs.append("--static-swift-stdlib")
@@ -250,9 +606,85 @@ def swift_execute(
         print("Planning run tests")
         print("Running tests for product {}".format(PRODUCT_NAME))
 
+    if on_line:
+        return check_call_streaming(popenargs, verbose, on_line)
     return check_call(popenargs, verbose)
 
 
+def _watched_files():
+    """Return the modification time of every gyb template and every file
+    the generated files were generated from."""
+    paths = set(LIBRARY_DIR.rglob("*.gyb"))
+    paths.update(LIBRARY_DIR.rglob("*.gyb.template"))
+    for path in LIBRARY_DIR.rglob(GYB_MANIFEST_FILE_NAME):
+        manifest = _load_gyb_manifest(path.parent.joinpath("autogenerated"))
+        for entry in manifest.values():
+            paths.update(map(Path, entry.get("inputs", {})))
+
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = path.stat().st_mtime_ns
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+
+def watch(
+    exec: Union[Path, str],
+    verbose: Optional[bool],
+    interval: float,
+    build: Optional[dict] = None,
+    **generate_options,
+):
+    """Regenerate the files whose inputs change until interrupted, and run
+    `swift build` with the `build` arguments after each regeneration.
+
+    Changes are polled every `interval` seconds, and a burst of changes is
+    only handled once the files stopped changing for an interval.
+    """
+    print("Watching for changes, press Ctrl-C to stop.")
+    mtimes = _watched_files()
+    try:
+        while True:
+            time.sleep(interval)
+            current = _watched_files()
+            if current == mtimes:
+                continue
+
+            # Debounce, editors often write a file more than once
+            while True:
+                time.sleep(interval)
+                latest = _watched_files()
+                if latest == current:
+                    break
+                current = latest
+
+            if verbose:
+                for path in sorted(set(current).union(mtimes)):
+                    if current.get(path) != mtimes.get(path):
+                        print("Changed: " + path.as_posix())
+
+            try:
+                generate_files(exec, verbose, **generate_options)
+                if build is not None:
+                    swift_execute(action="build", verbose=verbose, **build)
+            except subprocess.CalledProcessError as e:
+                printerr("FAIL: Executing: %s" % " ".join(e.cmd))
+            except Exception as e:
+                printerr("FAIL: Generating .gyb files failed")
+                printerr(e)
+
+            # Generating may have recorded new inputs, they are watched from
+            # now on. Changes made while generating are still picked up.
+            mtimes = {
+                path: current.get(path, mtime)
+                for path, mtime in _watched_files().items()
+            }
+    except KeyboardInterrupt:
+        return 0
+
+
 # -----------------------------------------------------------------------------
 # Arugment Parsing
 
@@ -268,6 +700,21 @@ def parse_args():
         help="Path to the gyb tool (default: %(default)s).",
     )
 
+    parser.add_argument(
+        "--gyb-cache-dir",
+        default=GYB_CACHE_DIR,
+        help="Directory of the persistent parsed gyb template cache, pass an "
+        "empty string to disable it (default: %(default)s).",
+    )
+
+    parser.add_argument(
+        "--gyb-socket",
+        default=GYB_SOCKET,
+        help="Unix socket of a running `gyb --serve` used to expand templates, "
+        "they are expanded in-process when no server listens on it, pass an "
+        "empty string to never use one (default: %(default)s).",
+    )
+
     parser.add_argument(
         "--degyb-only",
         action="store_true",
@@ -275,6 +722,31 @@ def parse_args():
         "rest of the build",
     )
 
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes used to expand gyb templates "
+        "(default: %(default)s).",
+    )
+
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and regenerate the files generated from gyb "
+        "whenever a template or a file they were generated from changes, "
+        "followed by an incremental build when --build is given.",
+    )
+
+    parser.add_argument(
+        "--watch-interval",
+        type=float,
+        default=0.5,
+        help="Seconds between checks for changes in --watch mode "
+        "(default: %(default)s).",
+    )
+
     parser.add_argument(
         "--generate-xcodeproj",
         action="store_true",
@@ -319,25 +791,82 @@ def parse_args():
         help="Run the tests in parallel.",
     )
 
+    parser.add_argument(
+        "--shard-count",
+        type=int,
+        default=1,
+        help="Split the test cases into this many shards of about the same "
+        "duration (default: %(default)s).",
+    )
+
+    parser.add_argument(
+        "--shard-index",
+        type=int,
+        default=0,
+        help="Run only the tests of this shard, counting from 0 "
+        "(default: %(default)s).",
+    )
+
+    parser.add_argument(
+        "--test-durations",
+        nargs="?",
+        const=TEST_DURATIONS_FILE,
+        metavar="PATH",
+        help="Record the duration of every test in PATH, report the test cases "
+        "that got slower and balance shards with them. Durations are only known "
+        "without --parallel (default PATH: {}).".format(TEST_DURATIONS_FILE),
+    )
+
+    parser.add_argument(
+        "--slowest-tests",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Print the N slowest tests after running them, this records test "
+        "durations like --test-durations (default: %(default)s).",
+    )
+
+    parser.add_argument(
+        "--test-regression-tolerance",
+        type=float,
+        default=0.2,
+        help="Relative slowdown of a test case against its recorded durations "
+        "that is reported (default: %(default)s).",
+    )
+
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="Enable verbose logging."
     )
     
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.shard_count < 1:
+        parser.error("--shard-count must be at least 1")
+    if not 0 <= args.shard_index < args.shard_count:
+        parser.error("--shard-index must be less than --shard-count")
+    return args
 
 
 def main():
     args = parse_args()
 
     try:
-        generate_files(args.gyb_path, verbose=args.verbose)
+        generate_files(
+            args.gyb_path,
+            verbose=args.verbose,
+            jobs=args.jobs,
+            cache_dir=args.gyb_cache_dir,
+            socket=args.gyb_socket,
+        )
     except subprocess.CalledProcessError as e:
         printerr("FAIL: Generating .gyb files failed")
         printerr("Executing: %s" % " ".join(e.cmd))
         fatal_error(e.output)
+    except Exception as e:
+        printerr("FAIL: Generating .gyb files failed")
+        fatal_error(e)
 
     # Skip the rest of the build if we should perform degyb only
-    if args.degyb_only:
+    if args.degyb_only and not args.watch:
         sys.exit(0)
 
     if args.generate_xcodeproj:
@@ -358,7 +887,67 @@ def main():
             printerr("Executing: %s" % " ".join(e.cmd))
             fatal_error(e.output)
 
+    if args.watch:
+        build = None
+        if args.build:
+            build = dict(
+                configuration=args.configuration,
+                product=PRODUCT_NAME,
+                sanitize=args.sanitize,
+                static_stdlib=args.static_swift_stdlib,
+            )
+        return watch(
+            args.gyb_path,
+            args.verbose,
+            args.watch_interval,
+            build,
+            jobs=args.jobs,
+            cache_dir=args.gyb_cache_dir,
+            socket=args.gyb_socket,
+        )
+
     if args.test:
+        filter = None
+        timings = None
+        # Test durations are only recorded, and the tests only discovered,
+        # when asked for.
+        durations_file = args.test_durations
+        if durations_file is None and (args.slowest_tests > 0 or args.shard_count > 1):
+            durations_file = TEST_DURATIONS_FILE
+        if durations_file is not None:
+            generate_linux_tests = _load_generate_linux_tests()
+            tests = generate_linux_tests.discover_tests(TESTS_DIR.as_posix(), args.jobs)
+            timings = TestTimings(
+                {name: module for module, classes in tests.items() for name, _ in classes}
+            )
+        if args.shard_count > 1:
+            # The shards are run with a --filter of their test cases, which
+            # would silently match nothing if discovery missed them all.
+            if not any(classes for classes in tests.values()):
+                fatal_error(
+                    "FAIL: No test cases found in {}, cannot shard the tests".format(
+                        TESTS_DIR.as_posix()
+                    )
+                )
+            shards = shard_test_cases(
+                tests,
+                _load_test_durations(durations_file),
+                args.shard_count,
+            )
+            test_cases = shards[args.shard_index]
+            print(
+                "Running shard {} of {}: {} test cases".format(
+                    args.shard_index + 1, args.shard_count, len(test_cases)
+                )
+            )
+            if not test_cases:
+                print("No tests in this shard.")
+                return 0
+            if args.verbose:
+                for test_case in test_cases:
+                    print("  " + test_case)
+            filter = _test_filter(test_cases)
+
         try:
             success = swift_execute(
                 action="test", 
@@ -368,6 +957,8 @@ def main():
                 parallel=args.parallel,
                 static_stdlib=args.static_swift_stdlib,
                 verbose=args.verbose,
+                filter=filter,
+                on_line=timings.feed if timings else None,
             ) == 0
             if success:
                 print("All tests passed!")
@@ -379,6 +970,15 @@ def main():
             printerr("FAIL: Running tests failed")
             printerr("Executing: %s" % " ".join(e.cmd))
             fatal_error(e.output)
+        finally:
+            if timings:
+                history = _load_test_history(durations_file)
+                timings.report(
+                    args.slowest_tests,
+                    _mean_test_durations(history),
+                    args.test_regression_tolerance,
+                )
+                timings.save(durations_file, history)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for gyb.
+
+Every phase of a template expansion is timed on its own: tokenize,
+parse_template, compile and execute_template. execute_template_plain is
+execute_template with line directives turned off, which shows what they
+cost. The real template is expanded for every kind in BASE_KIND_FILES,
+and synthetic templates are made by repeating it. Results can be written
+as JSON and compared against an earlier run to catch regressions.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import runpy
+import statistics
+import sys
+import time
+import tracemalloc
+
+UTILS_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.dirname(UTILS_DIR)
+
+sys.path.insert(0, UTILS_DIR)
+
+import gyb  # noqa: E402
+
+TEMPLATE_FILE = os.path.join(
+    PACKAGE_DIR, "Sources", "Backend", "Models", "Fluent.swift.gyb.template"
+)
+
+BUILD_SCRIPT_FILE = os.path.join(PACKAGE_DIR, "build-script.py")
+
+PHASES = [
+    "tokenize",
+    "parse_template",
+    "compile",
+    "execute_template",
+    "execute_template_plain",
+]
+
+PERCENTILES = [50, 90, 99]
+
+
+def base_kind_files():
+    """Return the kinds build-script.py generates files for."""
+    return runpy.run_path(BUILD_SCRIPT_FILE)["BASE_KIND_FILES"]
+
+
+def synthetic_template(text, scale):
+    """Return text repeated scale times, as one template."""
+    return "".join([text] * scale)
+
+
+def code_nodes(node):
+    """Yield every Code node in the given AST."""
+    if isinstance(node, gyb.Code):
+        yield node
+    for child in getattr(node, "children", ()):
+        for code in code_nodes(child):
+            yield code
+
+
+def compile_code_nodes(filename, nodes):
+    for node in nodes:
+        mode = "eval" if node.kind.startswith("substitution") else "exec"
+        compile(node.source, filename, mode)
+
+
+def execute_kinds(ast, kinds, line_directive):
+    lines = 0
+    for kind in kinds:
+        lines += gyb.execute_template(ast, line_directive, EMIT_KIND=kind).count("\n")
+    return lines
+
+
+def percentile(timings, p):
+    """Return the p-th percentile of timings, by nearest rank.
+
+    >>> percentile([4, 1, 3, 2], 50)
+    2
+    >>> percentile([4, 1, 3, 2], 99)
+    4
+    """
+    ordered = sorted(timings)
+    rank = max(int(math.ceil(p / 100.0 * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+def measure(func, repeat):
+    """Call func repeat times and return the timings in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def peak_memory(func):
+    """Call func once and return the peak traced memory in bytes."""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def summarize(timings):
+    summary = {"p%d" % p: percentile(timings, p) for p in PERCENTILES}
+    summary["min"] = min(timings)
+    summary["max"] = max(timings)
+    summary["mean"] = statistics.mean(timings)
+    return summary
+
+
+def bench_template(filename, text, kinds, line_directive, repeat, compiled):
+    """Return the number of lines output by expanding one template and the
+    measurements for every phase."""
+    ast = gyb.parse_template(filename, text)
+    nodes = list(code_nodes(ast))
+    if compiled:
+        ast = gyb.CompiledTemplate(ast)
+
+    phases = {
+        "tokenize": lambda: list(gyb.tokenize_template(text)),
+        "parse_template": lambda: gyb.parse_template(filename, text),
+        "compile": lambda: compile_code_nodes(filename, nodes),
+        "execute_template": lambda: execute_kinds(ast, kinds, line_directive),
+        "execute_template_plain": lambda: execute_kinds(ast, kinds, ""),
+    }
+
+    results = {}
+    for phase in PHASES:
+        func = phases[phase]
+        results[phase] = summarize(measure(func, repeat))
+        results[phase]["peak_memory"] = peak_memory(func)
+    return {
+        "output_lines": execute_kinds(ast, kinds, line_directive),
+        "phases": results,
+    }
+
+
+def run_benchmarks(
+    template_file, scales, kinds, line_directive, repeat, compiled, verbose
+):
+    with open(template_file, encoding="utf-8") as f:
+        text = f.read()
+
+    benchmarks = []
+    for scale in scales:
+        template = synthetic_template(text, scale)
+        if verbose:
+            print("Benchmarking {}x ({} chars)".format(scale, len(template)))
+        benchmark = {"scale": scale, "chars": len(template)}
+        benchmark.update(
+            bench_template(
+                template_file, template, kinds, line_directive, repeat, compiled
+            )
+        )
+        benchmarks.append(benchmark)
+
+    return {
+        "template": os.path.relpath(template_file, PACKAGE_DIR),
+        "kinds": kinds,
+        "repeat": repeat,
+        "compiled": compiled,
+        "gyb": gyb.version(),
+        "python": platform.python_version(),
+        "benchmarks": benchmarks,
+    }
+
+
+def print_results(results):
+    print(
+        "{:>6} {:<22} {:>11} {:>11} {:>11} {:>12} {:>10}".format(
+            "scale", "phase", "p50 ms", "p90 ms", "p99 ms", "chars/ms", "peak KiB"
+        )
+    )
+    for benchmark in results["benchmarks"]:
+        for phase in PHASES:
+            summary = benchmark["phases"][phase]
+            print(
+                "{:>6} {:<22} {:>11.3f} {:>11.3f} {:>11.3f} {:>12.0f} {:>10.0f}".format(
+                    benchmark["scale"],
+                    phase,
+                    summary["p50"] * 1000,
+                    summary["p90"] * 1000,
+                    summary["p99"] * 1000,
+                    benchmark["chars"] / max(summary["p50"] * 1000, 1e-9),
+                    summary["peak_memory"] / 1024,
+                )
+            )
+
+
+def compare_summaries(summaries, baseline, tolerance, label):
+    """Print the median of every summary against the one with the same key
+    in baseline and return the number of them that got slower by more than
+    tolerance. label formats the key of a summary for the output.
+
+    >>> compare_summaries({"a": {"p50": 1.5}, "b": {"p50": 1.0}},
+    ...                   {"a": {"p50": 1.0}}, 0.2, "{:>2}".format)
+     a   +50.0%  REGRESSION
+    1
+    """
+    regressions = 0
+    for key, new in summaries.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+        change = new["p50"] / old["p50"] - 1 if old["p50"] else 0
+        regressed = change > tolerance
+        regressions += regressed
+        print(
+            "{} {:>+8.1%}{}".format(
+                label(key), change, "  REGRESSION" if regressed else ""
+            )
+        )
+    return regressions
+
+
+def compare_results(results, baseline, tolerance):
+    """Print the median of every phase against baseline and return the
+    number of phases that got slower by more than tolerance."""
+
+    def phases(results):
+        return {
+            (benchmark["scale"], phase): benchmark["phases"][phase]
+            for benchmark in results["benchmarks"]
+            for phase in PHASES
+            if phase in benchmark["phases"]
+        }
+
+    return compare_summaries(
+        phases(results),
+        phases(baseline),
+        tolerance,
+        lambda key: "{:>6} {:<22}".format(*key),
+    )
+
+
+def add_output_arguments(parser, subject):
+    """Add the options shared by the benchmarks to parser: the number of
+    runs, and writing and comparing the results. subject names what
+    --compare checks for regressions."""
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Number of timed runs per measurement (default: %(default)s).",
+    )
+
+    parser.add_argument(
+        "-o", "--output", help="Write the results as JSON to this file."
+    )
+
+    parser.add_argument(
+        "--compare",
+        metavar="BASELINE",
+        help="Compare the results with a JSON file written by an earlier run, "
+        "exit with 1 if {} regressed.".format(subject),
+    )
+
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative slowdown of a median that is reported as a regression "
+        "(default: %(default)s).",
+    )
+
+
+def write_and_compare(results, args, compare_results):
+    """Write results to args.output and compare them with args.compare, as
+    the options add_output_arguments added ask, and return 1 if
+    compare_results found a regression."""
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare_results(results, baseline, args.tolerance):
+            return 1
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark gyb template expansion.")
+
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Enable verbose logging."
+    )
+
+    parser.add_argument(
+        "--template",
+        default=TEMPLATE_FILE,
+        help="The template to benchmark (default: %(default)s).",
+    )
+
+    parser.add_argument(
+        "--scale",
+        type=int,
+        action="append",
+        help="Repeat the template this many times, may be given more than once "
+        "(default: 1, 10, 100, 1000).",
+    )
+
+    parser.add_argument(
+        "--kind",
+        action="append",
+        help="Expand the template with this EMIT_KIND, may be given more than "
+        "once (default: every kind in BASE_KIND_FILES).",
+    )
+
+    parser.add_argument(
+        "--line-directive",
+        default=gyb._default_line_directive,
+        help="Line directive format string used when executing "
+        "(default: %(default)s).",
+    )
+
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Execute the template as a gyb.CompiledTemplate.",
+    )
+
+    add_output_arguments(parser, "a phase")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    results = run_benchmarks(
+        args.template,
+        args.scale or [1, 10, 100, 1000],
+        args.kind or base_kind_files(),
+        args.line_directive,
+        args.repeat,
+        args.compile,
+        args.verbose,
+    )
+    print_results(results)
+    return write_and_compare(results, args, compare_results)
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        sys.exit(1)
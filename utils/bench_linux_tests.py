@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for generate_linux_tests.
+
+Synthetic test suites are written to a temporary directory, with their test
+methods spread over test case classes, and some of them in `#if os(Linux)`
+blocks, then discovered with parse_source_file. Discovery should take time
+linear in the number of methods. Results can be written as JSON and compared
+against an earlier run to catch regressions.
+"""
+
+import argparse
+import os
+import platform
+import sys
+import tempfile
+
+UTILS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, UTILS_DIR)
+
+import generate_linux_tests  # noqa: E402
+from bench_gyb import (  # noqa: E402
+    add_output_arguments,
+    compare_summaries,
+    measure,
+    peak_memory,
+    summarize,
+    write_and_compare,
+)
+
+METHODS_PER_CLASS = 20
+
+CLASSES_PER_FILE = 5
+
+
+def synthetic_suite(name, methods):
+    """Return the source of a test file with methods test methods."""
+    lines = ["import XCTest\n", "\n"]
+    for i in range(methods):
+        if i % METHODS_PER_CLASS == 0:
+            if i:
+                lines.append("}\n\n")
+            lines.append(
+                "final class {}{}Tests: XCTestCase {{\n".format(
+                    name, i // METHODS_PER_CLASS
+                )
+            )
+        if i % 10 == 0:
+            lines += [
+                "#if os(Linux)\n",
+                "    func test{}() throws {{\n".format(i),
+                "    }\n",
+                "#else\n",
+                "    func test{}() throws {{\n".format(i),
+                "        XCTAssertTrue(true)\n",
+                "    }\n",
+                "#endif\n",
+            ]
+        else:
+            lines += [
+                "\n",
+                "    func test{}() throws {{\n".format(i),
+                "        let value = {}\n".format(i),
+                "        XCTAssertEqual(value, {})\n".format(i),
+                "    }\n",
+            ]
+    lines.append("}\n")
+    return "".join(lines)
+
+
+def write_suites(directory, methods):
+    """Write synthetic test files with methods test methods in total and
+    return their paths."""
+    per_file = METHODS_PER_CLASS * CLASSES_PER_FILE
+    paths = []
+    for i in range(0, methods, per_file):
+        name = "Suite{}".format(i // per_file)
+        path = os.path.join(directory, name + "Tests.swift")
+        with open(path, "w") as f:
+            f.write(synthetic_suite(name, min(per_file, methods - i)))
+        paths.append(path)
+    return paths
+
+
+def discover(paths):
+    methods = 0
+    for path in paths:
+        for _, tests in generate_linux_tests.parse_source_file(path, False):
+            methods += len(tests)
+    return methods
+
+
+def run_benchmarks(counts, repeat, verbose):
+    benchmarks = []
+    for count in counts:
+        with tempfile.TemporaryDirectory() as directory:
+            paths = write_suites(directory, count)
+            if verbose:
+                print("Benchmarking {} methods in {} files".format(count, len(paths)))
+            benchmark = {"methods": count, "files": len(paths)}
+            benchmark["discovered"] = discover(paths)
+            benchmark["discover"] = summarize(measure(lambda: discover(paths), repeat))
+            benchmark["discover"]["peak_memory"] = peak_memory(lambda: discover(paths))
+            benchmarks.append(benchmark)
+
+    return {
+        "repeat": repeat,
+        "python": platform.python_version(),
+        "benchmarks": benchmarks,
+    }
+
+
+def print_results(results):
+    print(
+        "{:>8} {:>6} {:>11} {:>11} {:>11} {:>10} {:>10}".format(
+            "methods", "files", "p50 ms", "p90 ms", "p99 ms", "us/method", "peak KiB"
+        )
+    )
+    for benchmark in results["benchmarks"]:
+        summary = benchmark["discover"]
+        print(
+            "{:>8} {:>6} {:>11.3f} {:>11.3f} {:>11.3f} {:>10.2f} {:>10.0f}".format(
+                benchmark["methods"],
+                benchmark["files"],
+                summary["p50"] * 1000,
+                summary["p90"] * 1000,
+                summary["p99"] * 1000,
+                summary["p50"] * 1e6 / max(benchmark["methods"], 1),
+                summary["peak_memory"] / 1024,
+            )
+        )
+
+
+def compare_results(results, baseline, tolerance):
+    """Print the median of every run against baseline and return the number
+    of runs that got slower by more than tolerance."""
+
+    def runs(results):
+        return {
+            benchmark["methods"]: benchmark["discover"]
+            for benchmark in results["benchmarks"]
+        }
+
+    return compare_summaries(runs(results), runs(baseline), tolerance, "{:>8}".format)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark Linux test discovery of generate_linux_tests."
+    )
+
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Enable verbose logging."
+    )
+
+    parser.add_argument(
+        "--methods",
+        type=int,
+        action="append",
+        help="Discover this many test methods, may be given more than once "
+        "(default: 100, 1000, 10000).",
+    )
+
+    add_output_arguments(parser, "discovery")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    results = run_benchmarks(
+        args.methods or [100, 1000, 10000], args.repeat, args.verbose
+    )
+    print_results(results)
+    return write_and_compare(results, args, compare_results)
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        sys.exit(1)
@@ -0,0 +1,382 @@
+"""
+The Fluent models defined in Fluent.json, loaded once per process and
+indexed for the gyb templates that generate them.
+
+Model keys should contains in:
+    - `schema`: required
+    - `properties`: required
+    - `codable`: optional, "DTO" by default, the name of the serializing struct.
+    - `compact_coding`: optional, If True the DTOs encode with generated `encode(to:)` that
+        skips nil and empty collection fields, and decode them back tolerantly.
+
+Property keys should contains in:
+    - `field_id`: optional
+        - "Field" or None: FieldProperty or OptionalFieldProperty
+        - "Enum"
+        - "ID": ID
+        - "Parent": ParentProperty or OptionalParentProperty
+        - "OptionalChild": OptionalChildProperty
+        - "Children": ChildrenProperty
+        - "Siblings: SiblingsProperty
+    - `field_key`: FieldKey, optional, by default, automatically generated by `name`.
+    - `name`: required
+    - `type`: optional, "String" by default, required unless `field_id` is "Field".
+    - `codable`: optional, If None use `type` instead.
+    - `exclude_from_codable`: optional, If True serializing protocol will not contains this field.
+    - `list_projection`: optional, If False list endpoints will not select or encode this field.
+    - `indexed`: optional, If True the generated index migration creates an index on this column.
+        For "Siblings" the index is on the pivot columns named after `parent_from_field` and
+        `parent_to_field`, in that order.
+    - `unique`: optional, Like `indexed`, but the index is unique.
+    - `parent_field`: Required and only available when `field_id` is "OptionalChild" or "Children".
+    - `through`: Required and only available when `field_id == "Siblings"`.
+    - `parent_from_field`: Required and only available when `field_id == "Siblings"`.
+    - `parent_to_field`: Required and only available when `field_id == "Siblings"`.
+"""
+
+import collections
+import json
+import os
+
+import gyb
+
+FIELD_TYPES = ["ID", "Field", "Enum", "Parent", "OptionalChild", "Children", "Siblings"]
+
+RELATION_FIELD_TYPES = ["Parent", "OptionalChild", "Children", "Siblings"]
+
+# A stored property of a DTO, for the generated `Codable` implementation.
+CodingField = collections.namedtuple(
+    "CodingField", ["name", "type", "is_optional", "is_collection"]
+)
+
+# An index hinted in Fluent.json; the table and columns are Swift expressions.
+Index = collections.namedtuple("Index", ["table", "columns", "name", "is_unique"])
+
+
+class SchemaError(ValueError):
+    """Fluent.json doesn't define valid models."""
+
+    def __init__(self, message, errors=()):
+        super().__init__(message)
+        self.errors = list(errors)
+
+
+MODEL_KEYS = {"schema": str, "properties": list, "codable": str, "compact_coding": bool}
+
+PROPERTY_KEYS = {
+    "field_id": str,
+    "field_key": str,
+    "name": str,
+    "type": str,
+    "codable": str,
+    "exclude_from_codable": bool,
+    "list_projection": bool,
+    "indexed": bool,
+    "unique": bool,
+    "parent_field": str,
+    "through": str,
+    "parent_from_field": str,
+    "parent_to_field": str,
+}
+
+# The keys properties of some field types must have, and that are only
+# available to them.
+FIELD_TYPE_KEYS = {
+    "Enum": ["type"],
+    "Parent": ["type"],
+    "OptionalChild": ["type", "parent_field"],
+    "Children": ["type", "parent_field"],
+    "Siblings": ["type", "through", "parent_from_field", "parent_to_field"],
+}
+
+_JSON_TYPE_NAMES = {str: "a string", list: "an array", bool: "a boolean", dict: "an object"}
+
+
+def json_path(*keys):
+    """Return the JSONPath of the value at keys.
+
+    >>> json_path("Blog", "properties", 8, "through")
+    '$.Blog.properties[8].through'
+    """
+    path = "$"
+    for key in keys:
+        if isinstance(key, int):
+            path += "[{}]".format(key)
+        elif key.isidentifier():
+            path += "." + key
+        else:
+            path += "[{}]".format(json.dumps(key))
+    return path
+
+
+def _validate_keys(value, keys, required, path, errors):
+    """Check that the object value only has the given keys, of the given
+    types, and every required one."""
+    for key in required:
+        if key not in value:
+            errors.append("{}: required".format(json_path(*path, key)))
+    for key, item in value.items():
+        if key not in keys:
+            errors.append("{}: unknown key".format(json_path(*path, key)))
+        elif not isinstance(item, keys[key]):
+            errors.append(
+                "{}: must be {}".format(json_path(*path, key), _JSON_TYPE_NAMES[keys[key]])
+            )
+
+
+def _validate_property(definition, path, errors):
+    if not isinstance(definition, dict):
+        errors.append("{}: must be an object".format(json_path(*path)))
+        return
+    _validate_keys(definition, PROPERTY_KEYS, ["name"], path, errors)
+
+    field_type = definition.get("field_id", "Field")
+    if field_type not in FIELD_TYPES:
+        errors.append(
+            "{}: unknown field type '{}', expected one of {}".format(
+                json_path(*path, "field_id"), field_type, ", ".join(FIELD_TYPES)
+            )
+        )
+        return
+
+    required = FIELD_TYPE_KEYS.get(field_type, [])
+    for key in required:
+        if key not in definition:
+            errors.append(
+                "{}: required when field_id is '{}'".format(json_path(*path, key), field_type)
+            )
+    for key in set(definition).difference(required):
+        if any(key in keys for keys in FIELD_TYPE_KEYS.values()) and key != "type":
+            errors.append(
+                "{}: not available when field_id is '{}'".format(
+                    json_path(*path, key), field_type
+                )
+            )
+
+    if definition.get("name") == "id" and not str(definition.get("type", "")).endswith("?"):
+        errors.append("{}: the type of 'id' must be optional".format(json_path(*path, "type")))
+
+    for key in ["indexed", "unique"]:
+        if definition.get(key) and (
+            definition.get("name") == "id"
+            or field_type not in ["Field", "Enum", "Parent", "Siblings"]
+        ):
+            errors.append(
+                "{}: only columns other than 'id' and siblings can be indexed".format(
+                    json_path(*path, key)
+                )
+            )
+
+    if definition.get("list_projection") is False and (
+        definition.get("name") == "id" or field_type not in ["Field", "Enum", "Parent"]
+    ):
+        errors.append(
+            "{}: only columns other than 'id' can be left out of the list projection".format(
+                json_path(*path, "list_projection")
+            )
+        )
+
+
+def validate(definitions):
+    """Return the errors in the parsed Fluent.json `definitions`, each
+    prefixed with the JSONPath of the offending value."""
+    if not isinstance(definitions, dict):
+        return ["$: must be an object of models"]
+
+    errors = []
+    for name, model in definitions.items():
+        path = [name]
+        if not isinstance(model, dict):
+            errors.append("{}: must be an object".format(json_path(*path)))
+            continue
+        _validate_keys(model, MODEL_KEYS, ["schema", "properties"], path, errors)
+
+        properties = model.get("properties")
+        if not isinstance(properties, list):
+            continue
+        names = set()
+        for i, definition in enumerate(properties):
+            _validate_property(definition, path + ["properties", i], errors)
+            if isinstance(definition, dict) and isinstance(definition.get("name"), str):
+                if definition["name"] in names:
+                    errors.append(
+                        "{}: duplicate property '{}'".format(
+                            json_path(*path, "properties", i, "name"), definition["name"]
+                        )
+                    )
+                names.add(definition["name"])
+    return errors
+
+
+def convert_to_snake_case(name):
+    return name[0].lower() + "".join(
+        "_" + character.lower() if character.isupper() else character
+        for character in name[1:]
+    )
+
+
+def is_optional(attribute):
+    return attribute.endswith("?")
+
+
+class Property(object):
+    """A property of a model, with everything the templates need to know
+    about it computed up front."""
+
+    def __init__(self, definition):
+        self.definition = definition
+        self.name = definition["name"]
+
+        if self.name == "id":
+            self.field_type = "ID"
+        else:
+            self.field_type = definition.get("field_id", "Field")
+
+        # The type of the model property and of the DTO property.
+        self.type = definition.get("type", "String")
+        if self.name == "id":
+            self.codable_type = self.type[:-1]
+        else:
+            self.codable_type = definition.get("codable", self.type)
+        self.is_optional = is_optional(self.type)
+        self.is_codable_optional = is_optional(self.codable_type)
+
+        self.field_key = definition.get("field_key", "FieldKeys." + self.name)
+        # Whether the model's FieldKeys declare the field key of this property
+        self.needs_field_key = not (
+            self.field_type in ["Children", "Siblings"]
+            or definition.get("field_key")
+            or self.name == "id"
+        )
+        self.column_name = convert_to_snake_case(self.name)
+        if self.field_type == "Parent":
+            self.column_name += "_id"
+
+        self.exclude_from_codable = bool(definition.get("exclude_from_codable"))
+        self.in_list_projection = definition.get("list_projection", True)
+        self.is_unique = bool(definition.get("unique"))
+        self.is_indexed = self.is_unique or bool(definition.get("indexed"))
+        # The model a relation links to, e.g. "BlogCategory" for "[BlogCategory]".
+        self.related_type = self.type.strip("[]?")
+        self.capitalized_name = self.name[0].upper() + self.name[1:]
+        self.parent_field = definition.get("parent_field")
+        self.through = definition.get("through")
+        self.parent_from_field = definition.get("parent_from_field")
+        self.parent_to_field = definition.get("parent_to_field")
+
+    def index(self, model_name):
+        """Return the Index hinted for this property of the model model_name."""
+        if self.field_type == "Siblings":
+            table = self.through
+            if table.endswith(".self"):
+                table = table[: -len(".self")]
+            table += ".schema"
+            names = [x.lstrip("$") for x in [self.parent_from_field, self.parent_to_field]]
+            columns = ['"{}"'.format(x) for x in names]
+        else:
+            table = model_name + ".schema"
+            names = [self.column_name]
+            field_key = self.field_key
+            if field_key.startswith("."):
+                field_key = "FieldKey" + field_key
+            columns = [field_key + ".description"]
+        return Index(
+            table, columns, "\\({})_{}_idx".format(table, "_".join(names)), self.is_unique
+        )
+
+
+class Model(object):
+    """A model and its properties, grouped the ways the templates use them."""
+
+    def __init__(self, name, definition):
+        self.name = name
+        self.definition = definition
+        self.schema = definition["schema"]
+        self.dto = definition.get("codable", "DTO")
+        self.compact_coding = bool(definition.get("compact_coding"))
+        self.properties = [Property(x) for x in definition["properties"]]
+
+        self.field_key_properties = [x for x in self.properties if x.needs_field_key]
+        self.codable_properties = [
+            x for x in self.properties if not x.exclude_from_codable
+        ]
+        self.updatable_properties = [
+            x for x in self.codable_properties if x.field_type != "ID"
+        ]
+        # The properties list endpoints encode, and whether leaving out the
+        # others needs a DTO of its own.
+        self.list_properties = [
+            x for x in self.codable_properties if x.in_list_projection
+        ]
+        self.has_list_dto = len(self.list_properties) < len(self.codable_properties)
+        # The indexes the generated index migration creates.
+        self.indexes = [x.index(name) for x in self.properties if x.is_indexed]
+        # The properties that can be eager loaded.
+        self.relation_properties = [
+            x for x in self.properties if x.field_type in RELATION_FIELD_TYPES
+        ]
+        self.siblings_properties = [
+            x for x in self.properties if x.field_type == "Siblings"
+        ]
+        # The properties stored in a column of the model's own table.
+        self.column_properties = [
+            x for x in self.properties if x.field_type in ["ID", "Field", "Enum", "Parent"]
+        ]
+
+    def coding_fields(self, properties):
+        """Return the CodingFields of a DTO of the given properties."""
+        fields = []
+        for x in properties:
+            fields.append(
+                CodingField(
+                    x.name,
+                    x.codable_type.rstrip("?"),
+                    x.is_codable_optional,
+                    x.codable_type.startswith("["),
+                )
+            )
+            if x.field_type == "Parent":
+                fields.append(CodingField(x.name + "Id", x.type + ".IDValue", True, False))
+        return fields
+
+
+def build_models(definitions, filename="Fluent.json"):
+    """Return the models of the parsed Fluent.json `definitions`, by name.
+
+    Raise SchemaError listing every error if they aren't valid.
+    """
+    errors = validate(definitions)
+    if errors:
+        raise SchemaError(
+            "{} is invalid:\n".format(filename) + "\n".join("  " + x for x in errors),
+            errors,
+        )
+    return {name: Model(name, definition) for name, definition in definitions.items()}
+
+
+# The models loaded by `load`, keyed by path, along with the modification time
+# and size of the file they were loaded from.
+_loaded_models = {}
+
+
+def load(path):
+    """Return the models defined in the Fluent.json file at `path`, by name.
+
+    The file is only read again when it changes.
+    """
+    path = os.path.abspath(path)
+    # Later calls don't open the file, but the output still depends on it.
+    gyb.add_dependency(path)
+
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    loaded = _loaded_models.get(path)
+    if loaded is None or loaded[0] != stamp:
+        with open(path, encoding="utf-8") as f:
+            try:
+                definitions = json.load(f)
+            except ValueError as e:
+                raise SchemaError("{} is invalid: {}".format(os.path.relpath(path), e))
+        loaded = (stamp, build_models(definitions, os.path.relpath(path)))
+        _loaded_models[path] = loaded
+    return loaded[1]
@@ -7,13 +7,26 @@ The ultimate tool for generate linux tests.
 from __future__ import print_function
 
 import argparse
+import hashlib
+import io
+import json
 import os
 import re
 import sys
+import tempfile
 
+# The classes found in every test file, with the modification time, size and
+# digest of the file they were found in, so unchanged files aren't parsed
+# again. Kept in the tests directory.
+CACHE_FILE_NAME = ".linux_tests.json"
+
+# Caches written with another version are rebuilt.
+CACHE_VERSION = 1
+
+CACHE_ENTRY_KEYS = frozenset(["mtime_ns", "size", "sha256", "classes"])
 
-def file_header(filename):
-    return """import XCTest
+
+FILE_HEADER = """import XCTest
 
 ///
 /// NOTE: This file was generated by generate_linux_tests.py
@@ -22,166 +35,366 @@ def file_header(filename):
 ///
 """
 
+DEPRECATED = '@available(*, deprecated, message: "not actually deprecated. Just deprecated to allow deprecated tests (which test deprecated functionality) without warnings")'
 
-def generate_test_extension_file(filename, classes, verbose):
-    test_ext_file = re.sub(".swift", "+XCTest.swift", filename)
-    if verbose:
-        print("Creating file: {}".format(test_ext_file))
+EXTENSION_TEMPLATE = """extension {name} {{
 
-    with open(test_ext_file, "w") as file:
-        file.write(file_header(test_ext_file))
-        file.write("\n")
+    {deprecated}
+    static var allTests: [(String, ({name}) -> () throws -> Void)] {{
+        return [
+{tests}        ]
+    }}
+}}
+"""
 
-        for class_array in classes:
-            file.write("extension " + class_array[0] + " {\n\n")
-            file.write('    @available(*, deprecated, message: "not actually deprecated. Just deprecated to allow deprecated tests (which test deprecated functionality) without warnings")\n')
-            file.write("    static var allTests: [(String, (" + class_array[0] + ") -> () throws -> Void)] {\n")
-            file.write("        return [\n")
+LINUX_MAIN_TEMPLATE = """
+#if os(Linux) || os(FreeBSD) || os(Android)
+{imports}
+// This protocol is necessary to we can call the 'run' method (on an existential of this protocol)
+// without the compiler noticing that we're calling a deprecated function.
+// This hack exists so we can deprecate individual tests which test deprecated functionality without
+// getting a compiler warning...
+protocol LinuxMainRunner {{ func run() }}
+
+class LinuxMainRunnerImpl: LinuxMainRunner {{
+    {deprecated}
+    func run() {{
+        XCTMain([
+{test_cases}        ])
+    }}
+}}
+
+(LinuxMainRunnerImpl() as LinuxMainRunner).run()
+#endif
+"""
 
-            for func in class_array[1]:
-                file.write('            ("' + func + '", ' + func + "),\n")
 
-            file.write("        ]\n")
-            file.write("    }\n")
-            file.write("}\n")
+def file_header(filename):
+    return FILE_HEADER
+
+
+def write_if_changed(filename, text, verbose=False):
+    """Atomically replace filename with text, unless it already has exactly
+    that content, and return whether it was written.
+
+    Leaving unchanged files untouched keeps their modification time, so
+    SwiftPM doesn't rebuild what depends on them. build-script.py writes
+    the files it generates with this too.
+    """
+    data = text.encode("utf-8")
+    try:
+        # Only read the file back when the size matches.
+        if os.path.getsize(filename) == len(data):
+            with open(filename, "rb") as file:
+                if file.read() == data:
+                    return False
+    except OSError:
+        pass
+
+    if verbose:
+        print("Creating file: {}".format(filename))
+
+    directory, name = os.path.split(filename)
+    fd, temp_file = tempfile.mkstemp(
+        prefix="." + name + ".", suffix=".tmp", dir=directory or "."
+    )
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        # mkstemp creates files only readable by the owner.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_file, 0o666 & ~umask)
+        os.replace(temp_file, filename)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+    return True
+
+
+def render_test_extension_file(filename, classes):
+    """Return the source of the extension file declaring `allTests` for
+    every class of classes."""
+    parts = [file_header(filename), "\n"]
+    for name, tests in classes:
+        parts.append(
+            EXTENSION_TEMPLATE.format(
+                name=name,
+                deprecated=DEPRECATED,
+                tests="".join('            ("{0}", {0}),\n'.format(x) for x in tests),
+            )
+        )
+    return "".join(parts)
+
+
+def generate_test_extension_file(filename, classes, verbose):
+    test_ext_file = filename[: -len(".swift")] + "+XCTest.swift"
+    text = render_test_extension_file(test_ext_file, classes)
+    return write_if_changed(test_ext_file, text, verbose)
+
+
+def render_linux_main(filename, all_test_sub_dir, files):
+    """Return the source of LinuxMain.swift, running the test cases of every
+    class in files."""
+    test_cases = sorted(class_array[0] for classes in files for class_array in classes)
+    return file_header(filename) + LINUX_MAIN_TEMPLATE.format(
+        imports="".join(
+            "    @testable import {}\n".format(x) for x in sorted(all_test_sub_dir)
+        ),
+        deprecated=DEPRECATED,
+        test_cases="".join(
+            "            testCase({}.allTests),\n".format(x) for x in test_cases
+        ),
+    )
 
 
 def generate_linux_main(tests_dir, all_test_sub_dir, files, verbose):
     filename = tests_dir + "/LinuxMain.swift"
-    if verbose:
-        print("Creating file: " + filename)
-
-    with open(filename, "w") as file:
-        file.write(file_header(filename))
-        file.write("\n")
-
-        file.write("#if os(Linux) || os(FreeBSD) || os(Android)\n")
-
-        if all_test_sub_dir:
-            all_test_sub_dir.sort()
-        for test_sub_dir in all_test_sub_dir:
-            file.write("    @testable import " + test_sub_dir + "\n")
-
-        file.write("\n")
-        file.write("// This protocol is necessary to we can call the 'run' method (on an existential of this protocol)\n")
-        file.write("// without the compiler noticing that we're calling a deprecated function.\n")
-        file.write("// This hack exists so we can deprecate individual tests which test deprecated functionality without\n")
-        file.write("// getting a compiler warning...\n")
-        file.write("protocol LinuxMainRunner { func run() }\n")
-        file.write("\n")
-        file.write("class LinuxMainRunnerImpl: LinuxMainRunner {\n")
-        file.write('    @available(*, deprecated, message: "not actually deprecated. Just deprecated to allow deprecated tests (which test deprecated functionality) without warnings")\n')
-        file.write("    func run() {\n")
-        file.write("        XCTMain([\n")
-
-        test_cases = []
-        for classes in files:
-            for class_array in classes:
-                test_cases.append(class_array[0])
-
-        if test_cases:
-            test_cases.sort()
-        for test_case in test_cases:
-            file.write("            testCase(" + test_case + ".allTests),\n")
-
-        file.write("        ])\n")
-        file.write("    }\n")
-        file.write("}\n\n")
-        file.write("(LinuxMainRunnerImpl() as LinuxMainRunner).run()\n")
-        file.write("#endif\n")
+    text = render_linux_main(filename, all_test_sub_dir, files)
+    return write_if_changed(filename, text, verbose)
+
+
+# A test case class, or a test method of the last one.
+TEST_RE = re.compile(
+    r"class[ \t]+(?P<class>[a-zA-Z0-9_]*)(?=[ \t]*:[ \t]*XCTestCase)"
+    r"|func[ \t]+(?P<func>test[a-zA-Z0-9_]*)(?=[ \t]*\(\))"
+)
+
+# A conditional compilation directive, and an `#if` that only holds on Linux.
+DIRECTIVE_RE = re.compile(r"[ \t]*#(if|elseif|else|endif)\b")
+LINUX_CONDITION_RE = re.compile(r"[ \t]*#if[ \t]+os\(Linux\)[ \t]*(//.*)?$")
+
+
+def scan_test_classes(lines):
+    """Return the test case classes in the Swift source lines, as
+    [name, [test, ...]].
+
+    Tests in the `#else` branch of an `#if os(Linux)` are skipped, since
+    they aren't compiled on Linux.
+
+    >>> scan_test_classes('''
+    ... final class FooTests: XCTestCase {
+    ...     func testA() {}
+    ... #if os(Linux)
+    ...     func testB() {}
+    ... #else
+    ...     #if DEBUG
+    ...     func testC() {}
+    ...     #endif
+    ...     func testD() {}
+    ... #endif
+    ...     func testE() throws {}
+    ...     func helper() {}
+    ... }
+    ... '''.splitlines(True))
+    [['FooTests', ['testA', 'testB', 'testE']]]
+    """
+    classes = []
+    current_class = None
+    # For every `#if` we are in, whether it is an `#if os(Linux)` and whether
+    # we are past its first branch, and the number of those we are past.
+    conditions = []
+    ignored = 0
+
+    for line in lines:
+        if "#" in line:
+            match = DIRECTIVE_RE.match(line)
+            if match:
+                directive = match.group(1)
+                if directive == "if":
+                    conditions.append([bool(LINUX_CONDITION_RE.match(line)), False])
+                elif not conditions:
+                    pass
+                elif directive == "endif":
+                    ignored -= conditions.pop()[1]
+                elif conditions[-1][0] and not conditions[-1][1]:
+                    conditions[-1][1] = True
+                    ignored += 1
+                continue
+
+        if ignored or ("class" not in line and "func" not in line):
+            continue
+
+        match = TEST_RE.search(line)
+        if not match:
+            continue
+
+        if match.group("class") is not None:
+            current_class = [match.group("class"), []]
+            classes.append(current_class)
+        elif current_class is not None:
+            current_class[1].append(match.group("func"))
+
+    return classes
 
 
 def parse_source_file(filename, verbose):
     if verbose:
         print("Parsing file:  " + filename)
 
-    classes = []
-    current_class = None
-    in_if_linux = False
-    in_else = False
-    ignore = False
-
-    #
-    # Read the file line by line
-    # and parse to find the class
-    # names and func names
-    #
+    # Read the file line by line rather than all at once.
     with open(filename) as file:
-        for line in file.readlines():
-            if in_if_linux:
-                if re.match(r"#else", line):
-                    in_else = True
-                    ignore = True
-                else:
-                    if re.match(r"#end", line):
-                        in_else = False
-                        in_if_linux = False
-                        ignore = False
-            else:
-                if re.match(r"#if[ \t]+os(Linux)", line):
-                    in_if_linux = True
-                    ignore = False
-
-            if ignore:
-                continue
+        return scan_test_classes(file)
 
-            # Match class or func
-            match = re.findall(r"class[ \t]+[a-zA-Z0-9_]*(?=[ \t]*:[ \t]*XCTestCase)|func[ \t]+test[a-zA-Z0-9_]*(?=[ \t]*\(\))", line)
-            if not match:
-                continue
-            match = match[0]
-
-            if (
-                re.findall(r"class", match)
-                and re.findall(r"class", match)[0] == "class"
-            ):
-                class_name = re.sub(r"^class[ \t]", "", match)
-                #
-                # Create a new class / func structure
-                # and add it to the classes array.
-                #
-                current_class = [class_name, []]
-                classes.append(current_class)
-            else:
-                func = re.sub(r"^func[ \t]", "", match)
-                #
-                # Add each func name the the class / func
-                # structure created above.
-                #
-                current_class[1].append(func)
 
-    return classes
+def scan_file(filename, digest=None):
+    """Return the modification time, size and digest of filename, and the
+    test case classes in it, or None if its digest is still digest."""
+    st = os.stat(filename)
+    with open(filename, "rb") as file:
+        data = file.read()
+    new_digest = hashlib.sha256(data).hexdigest()
+    if new_digest == digest:
+        return st.st_mtime_ns, st.st_size, new_digest, None
+    lines = io.StringIO(data.decode("utf-8"))
+    return st.st_mtime_ns, st.st_size, new_digest, scan_test_classes(lines)
 
 
-def generate_linux_test_files(tests_dir, verbose):
-    print("** Generating Linux Tests files **")
-    
-    all_test_sub_dir = []
-    all_files = []
+def load_cache(tests_dir):
+    """Return the cached test case classes of tests_dir, by file.
+
+    A cache that can't be read, or was written by another version of this
+    script, is ignored and rebuilt.
+    """
+    try:
+        with open(os.path.join(tests_dir, CACHE_FILE_NAME)) as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) or cache.get("version") != CACHE_VERSION:
+        return {}
+    files = cache.get("files")
+    if not isinstance(files, dict):
+        return {}
+    return {
+        filename: entry
+        for filename, entry in files.items()
+        if isinstance(entry, dict) and CACHE_ENTRY_KEYS.issubset(entry)
+    }
+
+
+def parse_test_files(filenames, cache, jobs, verbose):
+    """Return the test case classes in every file of filenames, by file,
+    only parsing the files that changed since they were cached, on up to
+    jobs worker processes.
+
+    cache is updated to the files parsed.
+    """
+    results = {}
+    stale = []
+    for filename in filenames:
+        entry = cache.get(filename)
+        st = os.stat(filename)
+        if entry and [entry["mtime_ns"], entry["size"]] == [st.st_mtime_ns, st.st_size]:
+            results[filename] = entry["classes"]
+        else:
+            stale.append(filename)
+
+    digests = [cache.get(x, {}).get("sha256") for x in stale]
+    if jobs <= 1 or len(stale) <= 1:
+        scanned = list(map(scan_file, stale, digests))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(min(jobs, len(stale))) as executor:
+            scanned = list(executor.map(scan_file, stale, digests))
+
+    for filename, (mtime_ns, size, digest, classes) in zip(stale, scanned):
+        if classes is None:
+            classes = cache[filename]["classes"]
+        elif verbose:
+            print("Parsed file:  " + filename)
+        cache[filename] = {
+            "mtime_ns": mtime_ns,
+            "size": size,
+            "sha256": digest,
+            "classes": classes,
+        }
+        results[filename] = classes
+
+    for filename in set(cache).difference(filenames):
+        del cache[filename]
+    return results
+
+
+def save_cache(tests_dir, cache):
+    write_if_changed(
+        os.path.join(tests_dir, CACHE_FILE_NAME),
+        json.dumps(
+            {"version": CACHE_VERSION, "files": cache}, indent=2, sort_keys=True
+        )
+        + "\n",
+        False,
+    )
 
-    for sub_dir_name in os.listdir(tests_dir):
+
+def find_test_files(tests_dir):
+    """Return the test files of every sub directory of tests_dir, which is
+    a test module, by module."""
+    test_files = {}
+    for sub_dir_name in sorted(os.listdir(tests_dir)):
         sub_dir = os.path.join(tests_dir, sub_dir_name)
         if not os.path.isdir(sub_dir):
             continue
 
-        dir_has_classes = False
-        for filename in os.listdir(sub_dir):
+        test_files[sub_dir_name] = []
+        for filename in sorted(os.listdir(sub_dir)):
             filename = os.path.join(sub_dir, filename)
-            if not os.path.isfile(filename):
+            if not os.path.isfile(filename) or filename.endswith("+XCTest.swift"):
                 continue
 
             if re.search(r"Tests?.swift$", filename):
-                file_classes = parse_source_file(filename, verbose)
-                #
-                # If there are classes in the
-                # test source file, create an extension
-                # file for it.
-                #
-                if len(file_classes) <= 0:
-                    continue
-                generate_test_extension_file(filename, file_classes, verbose)
-                dir_has_classes = True
-                all_files.append(file_classes)
+                test_files[sub_dir_name].append(filename)
+    return test_files
+
+
+def scan_test_files(tests_dir, jobs=1, verbose=False):
+    """Return the test files of every test module in tests_dir, by module,
+    and the test case classes in every one of them, by file, parsing only
+    the files that changed since the cache in tests_dir was saved."""
+    test_files = find_test_files(tests_dir)
+    cache = load_cache(tests_dir)
+    classes = parse_test_files(
+        [x for filenames in test_files.values() for x in filenames],
+        cache,
+        jobs,
+        verbose,
+    )
+    save_cache(tests_dir, cache)
+    return test_files, classes
+
+
+def discover_tests(tests_dir, jobs=1, verbose=False):
+    """Return the test case classes of every test module in tests_dir, as
+    [name, [test, ...]], by module."""
+    test_files, classes = scan_test_files(tests_dir, jobs, verbose)
+    return {
+        module: [x for filename in filenames for x in classes[filename]]
+        for module, filenames in test_files.items()
+    }
+
+
+def generate_linux_test_files(tests_dir, verbose, jobs=1):
+    print("** Generating Linux Tests files **")
+
+    test_files, classes = scan_test_files(tests_dir, jobs, verbose)
+
+    all_test_sub_dir = []
+    all_files = []
+    written = 0
+    for sub_dir_name, filenames in test_files.items():
+        dir_has_classes = False
+        for filename in filenames:
+            file_classes = classes[filename]
+            #
+            # If there are classes in the
+            # test source file, create an extension
+            # file for it.
+            #
+            if len(file_classes) <= 0:
+                continue
+            written += generate_test_extension_file(filename, file_classes, verbose)
+            dir_has_classes = True
+            all_files.append(file_classes)
 
         if dir_has_classes:
             all_test_sub_dir.append(sub_dir_name)
@@ -191,9 +404,12 @@ def generate_linux_test_files(tests_dir, verbose):
     # references all the classes and funcs in the source files.
     #
     if len(all_files) > 0:
-        generate_linux_main(tests_dir, all_test_sub_dir, all_files, verbose)
-    
-    print("** All tests generated **")
+        written += generate_linux_main(tests_dir, all_test_sub_dir, all_files, verbose)
+
+    if written:
+        print("** All tests generated **")
+    else:
+        print("** All tests are up to date **")
 
 
 def parse_args():
@@ -209,12 +425,21 @@ def parse_args():
 
     test_group.add_argument("--tests-dir", default="Tests", help="The path for the tests directory (default: %(default)s).")
 
+    test_group.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes used to parse changed test files "
+        "(default: %(default)s).",
+    )
+
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
-    generate_linux_test_files(args.tests_dir, args.verbose)
+    generate_linux_test_files(args.tests_dir, args.verbose, args.jobs)
     
 
 if __name__ == "__main__":
@@ -2,14 +2,23 @@
 # GYB: Generate Your Boilerplate (improved names welcome; at least
 # this one's short).  See -h output for instructions
 
+import ast as python_ast
+import copy
+import hashlib
+import importlib.util
 import io
+import marshal
 import os
+import pickle
 import re
 import sys
+import sysconfig
 import textwrap
 import tokenize
+import types
 from bisect import bisect
 from io import StringIO
+from numbers import Integral, Number
 
 
 def get_line_starts(s):
@@ -50,11 +59,11 @@ linesClose = r'[\ \t]* end [\ \t]* (?: \# .* )? $'
 
 # Note: Where "# Absorb" appears below, the regexp attempts to eat up
 # through the end of ${...} and %{...}% constructs.  In reality we
-# handle this with the Python tokenizer, which avoids mis-detections
-# due to nesting, comments and strings.  This extra absorption in the
-# regexp facilitates testing the regexp on its own, by preventing the
-# interior of some of these constructs from being treated as literal
-# text.
+# handle this with scan_python_to_unmatched_close_curly, which avoids
+# mis-detections due to nesting, comments and strings.  This extra
+# absorption in the regexp facilitates testing the regexp on its own, by
+# preventing the interior of some of these constructs from being treated
+# as literal text.
 tokenize_re = re.compile(
     r'''
 # %-lines and %{...}-blocks
@@ -93,59 +102,68 @@ tokenize_re = re.compile(
 gyb_block_close = re.compile(r'\}%[ \t]*\n?')
 
 
-def token_pos_to_index(token_pos, start, line_starts):
-    """Translate a tokenize (line, column) pair into an absolute
-    position in source text given the position where we started
-    tokenizing and a list that maps lines onto their starting
-    character indexes.
-    """
-    relative_token_line_plus1, token_col = token_pos
-
-    # line number where we started tokenizing
-    start_line_num = bisect(line_starts, start) - 1
-
-    # line number of the token in the whole text
-    abs_token_line = relative_token_line_plus1 - 1 + start_line_num
+# Python source up to the next character that matters when looking for the
+# end of an embedded ${...} or %{...}% construct
+_python_insignificant_re = re.compile(r'''[^{}'"#]*''')
 
-    # if found in the first line, adjust the end column to account
-    # for the extra text
-    if relative_token_line_plus1 == 1:
-        token_col += start - line_starts[start_line_num]
+# Python strings by their opening quote
+_python_string_re = dict(
+    (quote, re.compile(pattern, re.DOTALL)) for quote, pattern in [
+        ("'", r"'(?:[^'\\\n]|\\.)*'"),
+        ('"', r'"(?:[^"\\\n]|\\.)*"'),
+        ("'''", r"'''(?:[^'\\]|\\.|'(?!''))*'''"),
+        ('"""', r'"""(?:[^"\\]|\\.|"(?!""))*"""'),
+    ])
 
-    # Sometimes tokenizer errors report a line beyond the last one
-    if abs_token_line >= len(line_starts):
-        return line_starts[-1]
 
-    return line_starts[abs_token_line] + token_col
+def scan_python_to_unmatched_close_curly(source_text, start):
+    r"""Scan the Python code in source_text starting at index start,
+    matching open and close curly braces while skipping strings and
+    comments.  When an unmatched close curly brace is found, return its
+    index.  If not found, return len(source_text).  If a triple-quoted
+    string is not terminated, return the index where it starts.
 
+    This finds the same position as running Python's tokenizer from
+    start, in a single pass over the text.
 
-def tokenize_python_to_unmatched_close_curly(source_text, start, line_starts):
-    """Apply Python's tokenize to source_text starting at index start
-    while matching open and close curly braces.  When an unmatched
-    close curly brace is found, return its index.  If not found,
-    return len(source_text).  If there's a tokenization error, return
-    the position of the error.
+    >>> text = 'x ${ {"}": 1}["}"] # }\n } y'
+    >>> text[scan_python_to_unmatched_close_curly(text, 4):]
+    '} y'
+    >>> scan_python_to_unmatched_close_curly("{ '''}", 1)
+    2
     """
-    stream = StringIO(source_text)
-    stream.seek(start)
+    end = len(source_text)
+    pos = start
     nesting = 0
 
-    try:
-        for kind, text, token_start, token_end, line_text \
-                in tokenize.generate_tokens(stream.readline):
-
-            if text == '{':
-                nesting += 1
-            elif text == '}':
-                nesting -= 1
-                if nesting < 0:
-                    return token_pos_to_index(token_start, start, line_starts)
-
-    except tokenize.TokenError as error:
-        (message, error_pos) = error.args
-        return token_pos_to_index(error_pos, start, line_starts)
-
-    return len(source_text)
+    while True:
+        pos = _python_insignificant_re.match(source_text, pos).end()
+        if pos >= end:
+            return end
+
+        c = source_text[pos]
+        if c == '{':
+            nesting += 1
+            pos += 1
+        elif c == '}':
+            if nesting == 0:
+                return pos
+            nesting -= 1
+            pos += 1
+        elif c == '#':
+            pos = source_text.find('\n', pos)
+            if pos < 0:
+                return end
+        else:
+            quote = c * 3 if source_text.startswith(c * 3, pos) else c
+            m = _python_string_re[quote].match(source_text, pos)
+            if m:
+                pos = m.end()
+            elif len(quote) == 3:
+                return pos
+            else:
+                # Like the tokenizer, skip a stray quote and carry on
+                pos += 1
 
 
 def tokenize_template(template_text):
@@ -228,11 +246,9 @@ def tokenize_template(template_text):
     while pos < end:
         m = tokenize_re.match(template_text, pos, end)
 
-        # pull out the one matched key (ignoring internal patterns starting
-        # with _)
-        ((kind, text), ) = (
-            (kind, text) for (kind, text) in m.groupdict().items()
-            if text is not None and kind[0] != '_')
+        # The one matched key is the outermost, and so last closed, group
+        kind = m.lastgroup
+        text = m.group(kind)
 
         if kind in ('literal', 'symbol'):
             if len(saved_literal) == 0:
@@ -485,8 +501,8 @@ class ParseContext(object):
                 code_start = self.token_match.end(kind)
                 self.code_start_line = self.pos_to_line(code_start)
 
-                close_pos = tokenize_python_to_unmatched_close_curly(
-                    self.template, code_start, self.line_starts)
+                close_pos = scan_python_to_unmatched_close_curly(
+                    self.template, code_start)
                 self.code_text = self.template[code_start:close_pos]
                 yield kind
 
@@ -546,6 +562,8 @@ class ParseContext(object):
 _default_line_directive = \
     '// ###sourceLocation(file: "%(file)s", line: %(line)d)'
 
+_default_buffer_size = 64 * 1024
+
 
 class ExecutionContext(object):
 
@@ -555,31 +573,244 @@ class ExecutionContext(object):
                  **local_bindings):
         self.local_bindings = local_bindings
         self.line_directive = line_directive
+        self.line_directive_format = \
+            line_directive + '\n' if line_directive else None
         self.local_bindings['__context__'] = self
         self.result_text = []
-        self.last_file_line = None
-
-    def append_text(self, text, file, line):
+        # Where the last line of the output so far comes from
+        self.last_file = None
+        self.last_line = None
+        self.dependencies = set()
+        # Whether the output so far is empty or ends with a newline
+        self.at_line_start = True
+        self.sink = None
+        self.buffer_size = 0
+        self.buffered_size = 0
+
+    def stream_to(self, sink, buffer_size=_default_buffer_size):
+        r"""Write the output to the file-like object sink as it is
+        generated, holding at most about buffer_size characters in
+        result_text.
+
+        >>> ast = parse_template('dummy.file', text='% for i in range(3):\n'
+        ...                                         '${i}\n% end\n')
+        >>> out = StringIO()
+        >>> context = ExecutionContext(line_directive='')
+        >>> context.stream_to(out, buffer_size=1)
+        >>> context.execute(ast)
+        >>> print(out.getvalue(), end='')
+        0
+        1
+        2
+        >>> context.result_text
+        []
+        """
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self.flush()
+
+    def flush(self):
+        """Write the buffered output to the sink, if there is one"""
+        if self.sink is not None and self.result_text:
+            self.sink.write(''.join(self.result_text))
+            self.result_text = []
+            self.buffered_size = 0
+
+    def add_dependency(self, path):
+        """Record that the output depends on the file at path"""
+        path = os.path.abspath(path)
+        if not _is_library_file(path):
+            self.dependencies.add(path)
+
+    def execute(self, ast):
+        """Execute ast, recording every file it reads or imports"""
+        _install_dependency_hook()
+        _executing_contexts.append(self)
+        try:
+            ast.execute(self)
+        finally:
+            _executing_contexts.pop()
+        self.flush()
+
+        # Modules imported by an earlier expansion in this process don't
+        # get reopened, so find them through the resulting bindings.
+        for value in list(self.local_bindings.values()):
+            if not isinstance(value, types.ModuleType):
+                value = sys.modules.get(
+                    getattr(value, '__module__', None) or '')
+            path = getattr(value, '__file__', None)
+            if isinstance(path, str):
+                self.add_dependency(path)
+
+    def append_text(self, text, file, line, newlines=None):
+        """Append text that comes from the given (0-based) line of file.
+
+        newlines is the number of line breaks in text, when the caller
+        already knows it.
+        """
         # see if we need to inject a line marker
-        if self.line_directive:
-            if (file, line) != self.last_file_line:
-                # We can only insert the line directive at a line break
-                if len(self.result_text) == 0 \
-                   or self.result_text[-1].endswith('\n'):
-                    substitutions = {'file': file, 'line': line + 1}
-                    format_str = self.line_directive + '\n'
-                    self.result_text.append(format_str % substitutions)
-                # But if the new text contains any line breaks, we can create
-                # one
-                elif '\n' in text:
-                    i = text.find('\n')
-                    self.result_text.append(text[:i + 1])
-                    # and try again
-                    self.append_text(text[i + 1:], file, line + 1)
-                    return
+        if self.line_directive_format and (
+                line != self.last_line or file != self.last_file):
+            # We can only insert the line directive at a line break, but if
+            # the new text contains any line breaks, we can create one
+            if not self.at_line_start:
+                i = text.find('\n')
+                if i >= 0:
+                    self.write(text[:i + 1])
+                    text = text[i + 1:]
+                    line += 1
+                    if newlines is not None:
+                        newlines -= 1
+            if self.at_line_start and (
+                    line != self.last_line or file != self.last_file):
+                self.write(self.line_directive_format % {
+                    'file': file, 'line': line + 1})
+
+        self.write(text)
+        if newlines is None:
+            newlines = text.count('\n')
+        self.last_file = file
+        self.last_line = line + newlines
+
+    def append_result(self, result, file, line):
+        """Append the value of a ${...} substitution, unless it is None"""
+        if result is not None \
+                or (isinstance(result, str) and result != ''):
+            result_string = None
+            if isinstance(result, Number) and not isinstance(result, Integral):
+                result_string = repr(result)
+            elif isinstance(result, Integral) or isinstance(result, list):
+                result_string = str(result)
+            else:
+                result_string = result
+            self.append_text(result_string, file, line)
 
+    def write(self, text):
+        """Append text to the output, without any line directive"""
         self.result_text.append(text)
-        self.last_file_line = (file, line + text.count('\n'))
+        self.at_line_start = text.endswith('\n')
+        if self.sink is not None:
+            self.buffered_size += len(text)
+            if self.buffered_size >= self.buffer_size:
+                self.flush()
+
+
+# The contexts that are currently executing a template, innermost last
+_executing_contexts = []
+_dependency_hook_installed = False
+_library_paths = None
+
+
+def _is_library_file(path):
+    """Return True iff path belongs to the Python installation"""
+    global _library_paths
+    if _library_paths is None:
+        paths = sysconfig.get_paths()
+        _library_paths = tuple(set(
+            os.path.join(os.path.abspath(paths[name]), '')
+            for name in ('stdlib', 'platstdlib', 'purelib', 'platlib')
+            if name in paths))
+    return path.startswith(_library_paths)
+
+
+def _dependency_audit_hook(event, args):
+    if event != 'open' or not _executing_contexts:
+        return
+
+    path, mode, flags = args
+    if isinstance(path, bytes):
+        path = os.fsdecode(path)
+    if not isinstance(path, str):
+        return
+
+    # Only files that are read are inputs
+    if mode is None:
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return
+    elif any(c in mode for c in 'wax+'):
+        return
+
+    if path.endswith('.pyc'):
+        try:
+            path = importlib.util.source_from_cache(path)
+        except ValueError:
+            pass
+
+    _executing_contexts[-1].add_dependency(path)
+
+
+def _install_dependency_hook():
+    global _dependency_hook_installed
+    if not _dependency_hook_installed:
+        # Audit hooks can't be removed, so a single hook is installed for
+        # the lifetime of the process.
+        sys.addaudithook(_dependency_audit_hook)
+        _dependency_hook_installed = True
+
+
+def add_dependency(path):
+    """Record path as a dependency of the template being executed.
+
+    Helpers that memoize the data they load should call this, since
+    a memoized read doesn't open the file again.
+    """
+    if _executing_contexts:
+        _executing_contexts[-1].add_dependency(path)
+
+
+def escape_depfile_path(path):
+    r"""Escape path for use in a Make/Ninja depfile
+
+    >>> print(escape_depfile_path('/a b/$c#d'))
+    /a\ b/$$c\#d
+    """
+    return path.replace('\\', '/').replace(' ', '\\ ').replace(
+        '#', '\\#').replace('$', '$$')
+
+
+def write_depfile(f, target, dependencies):
+    r"""Write a Make/Ninja style depfile for target to the file f
+
+    >>> out = StringIO()
+    >>> write_depfile(out, 'out.swift', ['b.json', 'a.gyb'])
+    >>> print(out.getvalue(), end='')
+    out.swift: \
+      a.gyb \
+      b.json
+    """
+    f.write(escape_depfile_path(target) + ':')
+    for path in sorted(dependencies):
+        f.write(' \\\n  ' + escape_depfile_path(path))
+    f.write('\n')
+
+
+def compile_at_line(source, filename, mode, line):
+    """Compile source as if it started at the given (0-based) line of
+    filename
+
+    >>> code = compile_at_line('def f():\\n    pass\\n', 'f', 'exec', 9)
+    >>> (code.co_firstlineno, code.co_consts[0].co_firstlineno)
+    (10, 10)
+    """
+    try:
+        code = compile(source, filename, mode)
+    except SyntaxError as e:
+        if e.lineno is not None:
+            e.lineno += line
+        if getattr(e, 'end_lineno', None) is not None:
+            e.end_lineno += line
+        raise
+    return _shift_code_lines(code, line)
+
+
+def _shift_code_lines(code, offset):
+    # Line numbers are stored relative to co_firstlineno, except in nested
+    # code objects, which have their own.
+    return code.replace(
+        co_firstlineno=code.co_firstlineno + offset,
+        co_consts=tuple(
+            _shift_code_lines(x, offset) if isinstance(x, types.CodeType)
+            else x for x in code.co_consts))
 
 
 class ASTNode(object):
@@ -637,11 +868,13 @@ class Literal(ASTNode):
         self.text = context.token_text
         start_position = context.token_match.start(context.token_kind)
         self.start_line_number = context.pos_to_line(start_position)
+        self.newlines = self.text.count('\n')
         self.filename = context.filename
         context.next_token()
 
     def execute(self, context):
-        context.append_text(self.text, self.filename, self.start_line_number)
+        context.append_text(self.text, self.filename, self.start_line_number,
+                            self.newlines)
 
     def __str__(self, indent=''):
         return '\n'.join(
@@ -659,8 +892,13 @@ class Code(ASTNode):
 
     def __init__(self, context):
 
+        self.kind = context.token_kind
+        # The source starts at the first line of code rather than being
+        # padded with a newline for every line of the template before it;
+        # compile_at_line makes up for it.
+        first_line = context.code_start_line
         source = ''
-        source_line_count = 0
+        source_line_count = first_line
 
         def accumulate_code():
             s = source + (context.code_start_line - source_line_count) * '\n' \
@@ -700,9 +938,20 @@ class Code(ASTNode):
 
         self.filename = context.filename
         self.start_line_number = context.code_start_line
-        self.code = compile(source, context.filename, eval_exec)
+        self.code = compile_at_line(
+            source, context.filename, eval_exec, first_line)
         self.source = source
 
+    def __getstate__(self):
+        # Code objects can't be pickled, but they can be marshalled
+        state = self.__dict__.copy()
+        state['code'] = marshal.dumps(self.code)
+        return state
+
+    def __setstate__(self, state):
+        state['code'] = marshal.loads(state['code'])
+        self.__dict__.update(state)
+
     def execute(self, context):
         # Save __children__ from the local bindings
         save_children = context.local_bindings.get('__children__')
@@ -718,18 +967,7 @@ class Code(ASTNode):
 
         # If we got a result, the code was an expression, so append
         # its value
-        if result is not None \
-                or (isinstance(result, str) and result != ''):
-            from numbers import Number, Integral
-            result_string = None
-            if isinstance(result, Number) and not isinstance(result, Integral):
-                result_string = repr(result)
-            elif isinstance(result, Integral) or isinstance(result, list):
-                result_string = str(result)
-            else:
-                result_string = result
-            context.append_text(
-                result_string, self.filename, self.start_line_number)
+        context.append_result(result, self.filename, self.start_line_number)
 
     def __str__(self, indent=''):
         source_lines = re.sub(r'^\n', '', strip_trailing_nl(
@@ -743,6 +981,218 @@ class Code(ASTNode):
         return s + self.format_children(indent)
 
 
+# A line of a Code node's source that executes one of its children
+_child_placeholder_re = re.compile(
+    r'^([ \t]*)__children__\[(\d+)\]\.execute\(__context__\)$')
+
+
+def _has_multiline_string(source):
+    """Return True iff source has a string literal spanning several lines,
+    whose text would change if its lines were indented.
+
+    >>> _has_multiline_string("x = '''a\\nb'''\\n")
+    True
+    >>> _has_multiline_string('x = ("a"\\n     "b")\\n')
+    False
+    """
+    if '\n' not in source.strip():
+        return False
+    try:
+        for token in tokenize.generate_tokens(StringIO(source).readline):
+            if token.start[0] != token.end[0] and token.type not in (
+                    tokenize.NEWLINE, tokenize.NL):
+                return True
+    except (tokenize.TokenError, SyntaxError):
+        return True
+    return False
+
+
+def _scoped_lines(source):
+    """Return the numbers of the lines of source that are in the body of a
+    function or class it defines"""
+    lines = set()
+    for node in python_ast.walk(python_ast.parse(source)):
+        if isinstance(node, (python_ast.FunctionDef,
+                             python_ast.AsyncFunctionDef,
+                             python_ast.ClassDef)):
+            lines.update(range(node.body[0].lineno, node.end_lineno + 1))
+    return lines
+
+
+class CompiledTemplate(object):
+
+    r"""A template AST compiled into the code of a single Python module.
+
+    Literals become calls to __context__.append_text() with constant
+    arguments, substitutions become calls to __context__.append_result()
+    and %-lines become the control flow around them, so executing the
+    template evaluates one code object instead of walking the AST.  The
+    output, including line directives, is the same as executing the AST,
+    and the code keeps every statement on its line in the template.
+
+    A Code node nested in %-lines whose source has a multi-line string
+    literal can't be indented without changing the string, so it is
+    executed as an AST node instead.  So is the template's Prelude
+    candidate, which lets `body` share the code: it executes the template
+    with the Prelude replaced by an empty Block.  The body of a function or
+    class defined by %-lines is executed as an AST node as well, so that
+    its code runs in the template's globals, not in the function's scope.
+
+    >>> ast = parse_template('/dummy.file', text='''Nothing
+    ... % for i in range(2):
+    ... ${i}
+    ... % end
+    ... ''')
+    >>> compiled = CompiledTemplate(ast)
+    >>> print(compiled)
+    __context__.append_text('Nothing\n', '/dummy.file', 0, 1)
+    for i in range(2):
+        __context__.append_result((i), '/dummy.file', 2)
+        __context__.append_text('\n', '/dummy.file', 2, 1)
+    >>> print(execute_template(compiled, line_directive='#line %(line)d'),
+    ...       end='')
+    #line 1
+    Nothing
+    #line 3
+    0
+    #line 3
+    1
+
+    Functions defined by the template see the same bindings either way:
+
+    >>> ast = parse_template('/dummy.file', text='''% y = 'global'
+    ... % def f(y):
+    ... ${y}
+    ... %{ z = y }%
+    ... % end
+    ... % f('local')
+    ... ${z}
+    ... ''')
+    >>> interpreted = execute_template(ast, line_directive='')
+    >>> print(interpreted, end='')
+    global
+    global
+    >>> compiled = CompiledTemplate(ast)
+    >>> execute_template(compiled, line_directive='') == interpreted
+    True
+    """
+
+    def __init__(self, ast):
+        self.ast = ast
+        # The nodes that are executed as AST nodes
+        self.children = []
+        self.filename = None
+        self.prelude = Prelude.candidate(ast)
+
+        lines = []
+        line_numbers = []
+        self.emit_block(ast, '', lines, line_numbers)
+        self.source = '\n'.join(lines) + '\n' if lines else ''
+        self.code = self.compile(line_numbers)
+
+    @property
+    def body(self):
+        """This template without its Prelude candidate, for expansions
+        that evaluated the Prelude already"""
+        body = CompiledTemplate.__new__(CompiledTemplate)
+        body.__dict__.update(self.__dict__)
+        if self.prelude is not None:
+            empty = Block.__new__(Block)
+            empty.children = []
+            body.children = [empty if x is self.prelude else x
+                             for x in self.children]
+            body.prelude = None
+        return body
+
+    def emit_block(self, block, indent, lines, line_numbers):
+        for node in block.children:
+            if self.filename is None:
+                self.filename = node.filename
+            if isinstance(node, Literal):
+                lines.append('%s__context__.append_text(%r, %r, %d, %d)' % (
+                    indent, node.text, node.filename, node.start_line_number,
+                    node.newlines))
+                line_numbers.append(node.start_line_number + 1)
+            elif node is self.prelude or (
+                    indent and _has_multiline_string(node.source)):
+                lines.append('%s__children__[%d].execute(__context__)' % (
+                    indent, len(self.children)))
+                line_numbers.append(node.code.co_firstlineno)
+                self.children.append(node)
+            else:
+                self.emit_code(node, indent, lines, line_numbers)
+
+    def emit_code(self, node, indent, lines, line_numbers):
+        source_lines = strip_trailing_nl(node.source).split('\n')
+        first_line = node.code.co_firstlineno
+        if node.kind.startswith('substitution'):
+            source_lines[0] = '__context__.append_result(' + source_lines[0]
+            source_lines[-1] += ', %r, %d)' % (
+                node.filename, node.start_line_number)
+            scoped_lines = ()
+        else:
+            scoped_lines = _scoped_lines(node.source)
+
+        for i, line in enumerate(source_lines):
+            m = _child_placeholder_re.match(line)
+            if not m or i + 1 in scoped_lines:
+                if m:
+                    line = line.replace(
+                        '[%s]' % m.group(2), '[%d]' % len(self.children), 1)
+                    self.children.append(node.children[int(m.group(2))])
+                lines.append(indent + line if line else line)
+                line_numbers.append(first_line + i)
+                continue
+
+            child_indent = indent + m.group(1)
+            start = len(lines)
+            self.emit_block(node.children[int(m.group(2))], child_indent,
+                            lines, line_numbers)
+            if not any(x.strip() and not x.strip().startswith('#')
+                       for x in lines[start:]):
+                lines.append(child_indent + 'pass')
+                line_numbers.append(first_line + i)
+
+    def compile(self, line_numbers):
+        """Compile self.source, giving every statement the line number
+        of the template line it came from."""
+        filename = self.filename or '<gyb>'
+        tree = python_ast.parse(self.source, filename, 'exec')
+        for node in python_ast.walk(tree):
+            if getattr(node, 'lineno', None) is None:
+                continue
+            # Columns in the generated code don't match the template, so
+            # leave them out of tracebacks
+            node.col_offset = node.end_col_offset = -1
+            node.lineno = line_numbers[node.lineno - 1]
+            end_lineno = getattr(node, 'end_lineno', None)
+            if end_lineno is not None:
+                node.end_lineno = max(line_numbers[end_lineno - 1],
+                                      node.lineno)
+        return compile(tree, filename, 'exec')
+
+    def __getstate__(self):
+        # Code objects can't be pickled, but they can be marshalled
+        state = self.__dict__.copy()
+        state['code'] = marshal.dumps(self.code)
+        return state
+
+    def __setstate__(self, state):
+        state['code'] = marshal.loads(state['code'])
+        self.__dict__.update(state)
+
+    def execute(self, context):
+        save_children = context.local_bindings.get('__children__')
+        context.local_bindings['__children__'] = self.children
+        context.local_bindings['__file__'] = self.filename
+        exec(self.code, context.local_bindings)
+        context.local_bindings['__children__'] = save_children
+
+    def __str__(self, indent=''):
+        return '\n'.join(indent + x for x in
+                         strip_trailing_nl(self.source).split('\n'))
+
+
 def expand(filename, line_directive=_default_line_directive, **local_bindings):
     r"""Return the contents of the given template file, executed with the given
     local bindings.
@@ -804,6 +1254,410 @@ def expand(filename, line_directive=_default_line_directive, **local_bindings):
             os.chdir(d)
 
 
+# Names whose use in a %{...}% block, or in a function or class it defines,
+# makes its effect depend on the expansion it runs in.
+_prelude_unsafe_names = frozenset(
+    ['__context__', '__children__', 'eval', 'exec', 'globals', 'locals',
+     'vars'])
+
+
+def _global_names(code):
+    """Return the names of the globals, attributes and imports used by code
+    and by every code object nested in it"""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(_global_names(const))
+    return names
+
+
+class Prelude(object):
+
+    r"""A template's leading %{...}% block, evaluated once and shared by
+    every expansion of the template in this process.
+
+    The first Code node of a template is a prelude when it is a
+    %{...}% block that doesn't read any of the local bindings or the
+    execution context, neither in its top level code nor in the functions
+    and classes it defines, so that running it produces the same bindings
+    for every expansion.  Every expansion starts from a deep copy of those
+    bindings, so changes an expansion makes to them don't leak into the
+    next one.  Bindings that can't be copied are made by evaluating the
+    prelude again instead.
+
+    >>> ast = parse_template('/dummy.file', text='''%{
+    ... import json
+    ... kinds = []
+    ... def kind(value): return value.upper()
+    ... }%
+    ... % kinds.append(KIND)
+    ... ${kind(KIND)} ${kinds}
+    ... ''')
+    >>> prelude = Prelude.find(ast, ['KIND'])
+    >>> for kind in ('a', 'b'):
+    ...     context = prelude.context('', {'KIND': kind})
+    ...     context.execute(prelude.body)
+    ...     print(''.join(context.result_text), end='')
+    A ['a']
+    B ['b']
+    >>> Prelude.find(parse_template('/dummy.file', text='%{ x = KIND }%'),
+    ...              ['KIND']) is None
+    True
+
+    Functions defined by the block count too, whether the block calls them
+    or not:
+
+    >>> Prelude.find(parse_template('/dummy.file', text='''%{
+    ... def kind(): return KIND.upper()
+    ... kinds = [kind()]
+    ... }%'''), ['KIND']) is None
+    True
+    """
+
+    @staticmethod
+    def candidate(ast):
+        """Return the first Code node of ast if it is a %{...}% block, which
+        makes it the Prelude of expansions whose bindings it doesn't read"""
+        for node in ast.children:
+            if not isinstance(node, Code):
+                continue
+            if node.kind == 'gybBlockOpen' and not node.children:
+                return node
+            return None
+        return None
+
+    @staticmethod
+    def find(ast, binding_names):
+        """Return the Prelude of ast, or None if it has none"""
+        node = Prelude.candidate(ast)
+        if node is not None and _prelude_unsafe_names.union(
+                binding_names).isdisjoint(_global_names(node.code)):
+            return Prelude(node, ast)
+        return None
+
+    def __init__(self, node, ast):
+        self.node = node
+        # The template without the prelude
+        self.body = Block.__new__(Block)
+        self.body.children = [x for x in ast.children if x is not node]
+        self.bindings = None
+        self.copyable = True
+        self.dependencies = set()
+        self.shared_bindings = None
+
+    def evaluate(self):
+        context = ExecutionContext(line_directive='')
+        context.execute(self.node)
+        self.shared_bindings = context.local_bindings
+        self.bindings = dict(self.shared_bindings)
+        del self.bindings['__context__']
+        self.dependencies = context.dependencies
+        try:
+            self.copy_bindings()
+        except Exception:
+            self.copyable = False
+
+    def copy_bindings(self):
+        """Return a deep copy of the prelude's bindings, sharing only the
+        modules and the builtins"""
+        memo = dict((id(x), x) for x in self.bindings.values()
+                    if isinstance(x, types.ModuleType))
+        builtins = self.bindings.get('__builtins__')
+        memo[id(builtins)] = builtins
+        return copy.deepcopy(self.bindings, memo)
+
+    def context(self, line_directive, local_bindings):
+        """Return an ExecutionContext for executing self.body with the
+        given local bindings, as if the prelude had just run."""
+        if self.bindings is None:
+            self.evaluate()
+
+        context = ExecutionContext(line_directive=line_directive)
+        context.local_bindings = self.shared_bindings
+        context.local_bindings.clear()
+        context.local_bindings.update(local_bindings)
+        context.local_bindings['__context__'] = context
+        if self.copyable:
+            context.local_bindings.update(self.copy_bindings())
+        else:
+            context.execute(self.node)
+        context.dependencies.update(self.dependencies)
+        return context
+
+
+# Templates parsed by expand_all, keyed by absolute path and whether they are
+# compiled. Worker processes that are forked inherit them instead of parsing
+# the template again.
+_parsed_templates = {}
+# The Prelude of every template in _parsed_templates, keyed by the template's
+# absolute path and the names of its local bindings.
+_preludes = {}
+
+
+def _parsed_template(filename, cache=None, compiled=False):
+    template = _parsed_templates.get((filename, compiled))
+    if template is None:
+        if cache:
+            template = cache.parse(filename, compiled=compiled)
+        else:
+            template = parse_template(filename)
+            if compiled:
+                template = CompiledTemplate(template)
+        _parsed_templates[(filename, compiled)] = template
+    return template
+
+
+def _expand_parsed(filename, cache, line_directive, local_bindings,
+                   compiled=False):
+    template = _parsed_template(filename, cache, compiled)
+    ast = template.ast if compiled else template
+
+    # Allow the template to open files and import .py files relative to its
+    # own directory
+    directory = os.path.dirname(filename)
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    d = os.getcwd()
+    os.chdir(directory)
+    try:
+        key = (filename, frozenset(local_bindings))
+        if key not in _preludes:
+            _preludes[key] = Prelude.find(ast, local_bindings)
+        prelude = _preludes[key]
+
+        if prelude:
+            context = prelude.context(line_directive, local_bindings)
+            context.execute(template.body if compiled else prelude.body)
+        else:
+            context = ExecutionContext(
+                line_directive=line_directive, **local_bindings)
+            context.execute(template)
+    finally:
+        os.chdir(d)
+    return ''.join(context.result_text), sorted(context.dependencies)
+
+
+# The modification times of the template and every file it depended on the
+# last time expand_all expanded it, keyed by the template's absolute path.
+_expanded_files = {}
+
+
+def _forget_stale_templates():
+    """Drop what this process knows about every template that, or a file it
+    read or imported, changed since it was last expanded, and the modules
+    imported from the changed files.
+
+    Every template is checked, not just the one about to be expanded: a
+    module imported by one template is shared by every template that
+    imports it afterwards.
+    """
+    changed = set()
+    for files in _expanded_files.values():
+        for path, mtime in files.items():
+            if path in changed:
+                continue
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    changed.add(path)
+            except OSError:
+                changed.add(path)
+    if not changed:
+        return
+
+    for filename, files in list(_expanded_files.items()):
+        if changed.isdisjoint(files):
+            continue
+        del _expanded_files[filename]
+        for key in [x for x in _parsed_templates if x[0] == filename]:
+            del _parsed_templates[key]
+        for key in [x for x in _preludes if x[0] == filename]:
+            del _preludes[key]
+    # Import changed modules again the next time a template runs
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, '__file__', None)
+        if isinstance(path, str) and os.path.abspath(path) in changed:
+            del sys.modules[name]
+
+
+def _record_expanded_files(filename, results):
+    files = {}
+    for path in [filename] + [x for _, paths in results for x in paths]:
+        try:
+            files[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            pass
+    _expanded_files[filename] = files
+
+
+def expand_all(filename, binding_sets, line_directive=_default_line_directive,
+               jobs=1, cache=None, compiled=False):
+    r"""Expand the given template file once for every dictionary of local
+    bindings in binding_sets.
+
+    The template is parsed only once, through the TemplateCache `cache` if
+    one is given, and turned into a CompiledTemplate if `compiled` is true.
+    Its Prelude (if any) is evaluated once per process, and up to `jobs`
+    worker processes execute it.  Long-running processes keep all that
+    until the template, or a file it read or imported, changes.  Return a
+    list of (text, dependencies) pairs, in the order of binding_sets,
+    where dependencies lists the files read or imported while generating
+    the text.
+
+    >>> from tempfile import NamedTemporaryFile
+    >>> f = NamedTemporaryFile(delete=False)
+    >>> _ = f.write(b'kind: ${KIND}\n')
+    >>> f.close()
+    >>> for text, _ in expand_all(f.name, [{'KIND': 'a'}, {'KIND': 'b'}],
+    ...                           line_directive=''):
+    ...     print(text, end='')
+    kind: a
+    kind: b
+    >>> os.remove(f.name)
+
+    Expanding a template again imports the modules it imports again if they
+    changed, even if another template imported them first:
+
+    >>> import shutil, tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> def write(name, text):
+    ...     with open(os.path.join(d, name), 'w') as f:
+    ...         _ = f.write(text)
+    >>> def expand_one(name):
+    ...     text, _ = expand_all(os.path.join(d, name), [{}],
+    ...                          line_directive='')[0]
+    ...     print(text, end='')
+    >>> write('gyb_test_helper.py', 'KIND = "old"\n')
+    >>> for name in ('a', 'b'):
+    ...     write(name + '.gyb', '%{ import gyb_test_helper }%\n'
+    ...                          + name + ': ${gyb_test_helper.KIND}\n')
+    >>> expand_one('a.gyb')
+    a: old
+    >>> write('gyb_test_helper.py', 'KIND = "new"\n')
+    >>> # A different modification time, however coarse the file system's
+    >>> os.utime(os.path.join(d, 'gyb_test_helper.py'), ns=(0, 0))
+    >>> expand_one('b.gyb')
+    b: new
+    >>> expand_one('a.gyb')
+    a: new
+    >>> shutil.rmtree(d)
+    """
+    filename = os.path.abspath(filename)
+    _forget_stale_templates()
+    _parsed_template(filename, cache, compiled)
+
+    if jobs <= 1 or len(binding_sets) <= 1:
+        results = [_expand_parsed(filename, cache, line_directive, bindings,
+                                  compiled)
+                   for bindings in binding_sets]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(min(jobs, len(binding_sets))) as executor:
+            futures = [
+                executor.submit(
+                    _expand_parsed, filename, cache, line_directive, bindings,
+                    compiled)
+                for bindings in binding_sets]
+            results = [future.result() for future in futures]
+
+    _record_expanded_files(filename, results)
+    return results
+
+
+class ServerError(Exception):
+
+    """The gyb server could not expand a template"""
+
+
+def serve(socket_path, cache=None):
+    """Expand templates for expand_remote() on the Unix socket at
+    socket_path, until interrupted.
+
+    Templates are expanded in this process, one request at a time, so
+    parsed and compiled templates and their Preludes stay in memory
+    between requests, see expand_all().  Worker processes would start
+    without them, so the number of jobs a request asks for is ignored.
+    """
+    import json
+    import signal
+    import socketserver
+    import traceback
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline().decode('utf-8'))
+                if request['gyb'] != version():
+                    raise ServerError('the gyb server runs a different gyb')
+                results = expand_all(
+                    request['template'], request['binding_sets'],
+                    request['line_directive'], 1, cache,
+                    request['compiled'])
+                response = {'results': results}
+            except Exception:
+                response = {'error': traceback.format_exc()}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+    try:
+        # Replace the socket of a server that is gone
+        os.remove(socket_path)
+    except OSError:
+        pass
+    directory = os.path.dirname(os.path.abspath(socket_path))
+    os.makedirs(directory, exist_ok=True)
+
+    # Clean up the socket when stopped with kill
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    with socketserver.UnixStreamServer(socket_path, Handler) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            try:
+                os.remove(socket_path)
+            except OSError:
+                pass
+
+
+def expand_remote(socket_path, filename, binding_sets,
+                  line_directive=_default_line_directive, jobs=1,
+                  compiled=False):
+    """Like expand_all(), but have the gyb server listening on the Unix
+    socket at socket_path expand the template.  The server expands it in
+    its own process, whatever jobs is.
+
+    Raise OSError if no server is listening there, and ServerError if the
+    server runs a different version of gyb or failed to expand the
+    template.
+    """
+    import json
+    import socket
+
+    request = {
+        'gyb': version(),
+        'template': os.path.abspath(filename),
+        'binding_sets': binding_sets,
+        'line_directive': line_directive,
+        'jobs': jobs,
+        'compiled': compiled,
+    }
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with s.makefile('rb') as f:
+            response = f.readline()
+    if not response:
+        raise ServerError('the gyb server closed the connection')
+
+    response = json.loads(response.decode('utf-8'))
+    if 'error' in response:
+        raise ServerError(response['error'])
+    return [(text, dependencies)
+            for text, dependencies in response['results']]
+
+
 def parse_template(filename, text=None):
     r"""Return an AST corresponding to the given template file.
 
@@ -1121,10 +1975,142 @@ def execute_template(
     """
     execution_context = ExecutionContext(
         line_directive=line_directive, **local_bindings)
-    ast.execute(execution_context)
+    execution_context.execute(ast)
     return ''.join(execution_context.result_text)
 
 
+_default_cache_size = 64 * 1024 * 1024
+
+
+class TemplateCache(object):
+
+    r"""A persistent, size-bounded cache of parsed templates.
+
+    Parsed ASTs, including the compiled code of their Code nodes, and
+    CompiledTemplates are stored in `directory` keyed by the SHA-256 of the
+    template text, its file name, the Python bytecode version and the
+    version of gyb itself.
+    When the cache grows beyond `max_size` bytes, the least recently used
+    entries are evicted.
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> cache = TemplateCache(d)
+    >>> text = '% for i in range(2):\n${i}\n% end\n'
+    >>> print(execute_template(cache.parse('/dummy.file', text),
+    ...                        line_directive=''), end='')
+    0
+    1
+    >>> print(execute_template(cache.parse('/dummy.file', text),
+    ...                        line_directive=''), end='')
+    0
+    1
+    >>> (cache.hits, cache.misses)
+    (1, 1)
+    >>> shutil.rmtree(d)
+    """
+
+    suffix = '.gybast'
+
+    def __init__(self, directory, max_size=_default_cache_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, filename, text, compiled=False):
+        h = hashlib.sha256()
+        for part in (version(), importlib.util.MAGIC_NUMBER.hex(),
+                     os.path.abspath(filename), text,
+                     'compiled' if compiled else 'ast'):
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def parse(self, filename, text=None, compiled=False):
+        """Return the AST for the given template, or its CompiledTemplate if
+        compiled is true, parsing it only if no cached copy exists."""
+        if text is None:
+            with io.open(os.path.normpath(filename), encoding='utf-8') as f:
+                text = f.read()
+
+        path = os.path.join(self.directory,
+                            self.key(filename, text, compiled) + self.suffix)
+        try:
+            with open(path, 'rb') as f:
+                ast = pickle.load(f)
+        except (OSError, EOFError, ValueError, TypeError,
+                pickle.UnpicklingError):
+            pass
+        else:
+            self.hits += 1
+            try:
+                # Record the access for the LRU eviction
+                os.utime(path)
+            except OSError:
+                pass
+            return ast
+
+        self.misses += 1
+        ast = parse_template(filename, text)
+        if compiled:
+            ast = CompiledTemplate(ast)
+        self.store(path, ast)
+        return ast
+
+    def store(self, path, ast):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp, 'wb') as f:
+                pickle.dump(ast, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except (OSError, pickle.PicklingError, RecursionError):
+            # The cache is an optimization; never fail a build because of it
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+        max_size bytes."""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(self.suffix):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+
+
+_gyb_digest = None
+
+
+def version():
+    """Return a digest of this file, so that cached ASTs are invalidated
+    whenever gyb itself changes."""
+    global _gyb_digest
+    if _gyb_digest is None:
+        with open(os.path.abspath(__file__), 'rb') as f:
+            _gyb_digest = hashlib.sha256(f.read()).hexdigest()
+    return _gyb_digest
+
+
 def main():
     import argparse
     import sys
@@ -1197,6 +2183,17 @@ def main():
         default=[],
         help='''Bindings to be set in the template's execution context''')
 
+    parser.add_argument(
+        '--foreach', action='append', dest='foreach', metavar='NAME=V1,V2,...',
+        default=[],
+        help='''Expand the template once for every value of NAME (and for
+             every combination of values when given more than once).  The
+             output file name is formatted with the bindings, as in
+             `-o autogenerated/{NAME}.swift`''')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count() or 1,
+        help='''Number of worker processes used by --foreach
+             (default: %(default)s)''')
     parser.add_argument(
         'file', type=str,
         help='Path to GYB template file (defaults to stdin)', nargs='?',
@@ -1204,6 +2201,10 @@ def main():
     parser.add_argument(
         '-o', dest='target', type=str,
         help='Output file (defaults to stdout)', default='-')
+    parser.add_argument(
+        '-MF', dest='depfile', type=str,
+        help='''Write a Make/Ninja style depfile listing the template and
+             every file it reads or imports''')
     parser.add_argument(
         '--test', action='store_true',
         default=False, help='Run a self-test')
@@ -1213,6 +2214,29 @@ def main():
     parser.add_argument(
         '--dump', action='store_true',
         default=False, help='Dump the parsed template to stdout')
+    parser.add_argument(
+        '--compile', action='store_true',
+        default=False,
+        help='''Compile the template into a single Python code object instead
+             of interpreting its AST (--dump then prints the generated
+             Python)''')
+    parser.add_argument(
+        '--cache-dir', default=os.environ.get('GYB_CACHE_DIR'),
+        help='''Directory of the persistent parsed-template cache
+             (defaults to $GYB_CACHE_DIR, caching is disabled if unset)''')
+    parser.add_argument(
+        '--cache-size', type=int, default=_default_cache_size,
+        help='''Maximum size in bytes of the parsed-template cache
+             (default: %(default)s)''')
+    parser.add_argument(
+        '--serve', action='store_true', default=False,
+        help='''Serve template expansions to build tools (see
+             expand_remote) on the Unix socket given by --socket, keeping
+             templates parsed and compiled between requests''')
+    parser.add_argument(
+        '--socket', default=os.environ.get('GYB_SOCKET'),
+        help='''Path of the Unix socket used by --serve (defaults to
+             $GYB_SOCKET)''')
     parser.add_argument(
         '--line-directive',
         default=_default_line_directive,
@@ -1235,23 +2259,87 @@ def main():
             sys.exit(1)
 
     bindings = dict(x.split('=', 1) for x in args.defines)
+    cache = None
+    if args.cache_dir:
+        cache = TemplateCache(args.cache_dir, args.cache_size)
+    if args.serve:
+        if not args.socket:
+            parser.error('--serve requires a socket path (--socket)')
+        serve(args.socket, cache)
+        return
     if args.file == '-':
         ast = parse_template('stdin', sys.stdin.read())
+    elif cache:
+        ast = cache.parse(args.file, compiled=args.compile)
     else:
         with io.open(os.path.normpath(args.file), 'r', encoding='utf-8') as f:
             ast = parse_template(args.file, f.read())
+    if args.compile and not isinstance(ast, CompiledTemplate):
+        ast = CompiledTemplate(ast)
     if args.dump:
         print(ast)
+    if args.depfile and args.target == '-':
+        parser.error('-MF requires an output file (-o)')
+    if args.foreach:
+        if args.file == '-':
+            parser.error('--foreach requires a template file')
+        if args.target == '-':
+            parser.error('--foreach requires an output file pattern (-o)')
+    filename = os.path.abspath(args.file)
+    # Output files and depfiles are relative to the working directory gyb was
+    # started in. Depfiles still name the outputs as given, which is what the
+    # build system asked for.
+    cwd = os.getcwd()
     # Allow the template to open files and import .py files relative to its own
     # directory
-    os.chdir(os.path.dirname(os.path.abspath(args.file)))
+    os.chdir(os.path.dirname(filename))
     sys.path = ['.'] + sys.path
 
+    if args.foreach:
+        import itertools
+        names, values = [], []
+        for x in args.foreach:
+            name, value = x.split('=', 1)
+            names.append(name)
+            values.append(value.split(','))
+        binding_sets = [dict(bindings, **dict(zip(names, combination)))
+                        for combination in itertools.product(*values)]
+        targets = [args.target.format(**x) for x in binding_sets]
+        if len(set(targets)) != len(targets):
+            parser.error('the output file pattern must use every --foreach '
+                         'NAME, as in -o {%s}.swift' % names[0])
+
+        _parsed_templates[(filename, args.compile)] = ast
+        results = expand_all(filename, binding_sets, args.line_directive,
+                             args.jobs, cache, args.compile)
+        for binding_set, target, (text, dependencies) in zip(
+                binding_sets, targets, results):
+            with io.open(os.path.join(cwd, target), 'w', encoding='utf-8',
+                         newline='\n') as f:
+                f.write(text)
+            if args.depfile:
+                depfile = os.path.join(cwd, args.depfile.format(**binding_set))
+                with io.open(depfile, 'w', encoding='utf-8',
+                             newline='\n') as f:
+                    write_depfile(f, target, dependencies + [filename])
+        return
+
+    context = ExecutionContext(line_directive=args.line_directive, **bindings)
     if args.target == '-':
-        sys.stdout.write(execute_template(ast, args.line_directive, **bindings))
+        context.execute(ast)
+        sys.stdout.write(''.join(context.result_text))
     else:
-        with io.open(args.target, 'w', encoding='utf-8', newline='\n') as f:
-            f.write(execute_template(ast, args.line_directive, **bindings))
+        with io.open(os.path.join(cwd, args.target), 'w', encoding='utf-8',
+                     newline='\n') as f:
+            context.stream_to(f)
+            context.execute(ast)
+
+    if args.depfile:
+        if args.file != '-':
+            context.dependencies.add(filename)
+        with io.open(os.path.join(cwd, args.depfile), 'w', encoding='utf-8',
+                     newline='\n') as f:
+            write_depfile(f, args.target, context.dependencies)
 
 
 if __name__ == '__main__':